@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import warnings
+import validators
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+from fetcher import fetch_pob_codes
+from pobutils import Build, parse_build
+from pricestore import PriceStore, SUMMARY_KEYS, has_price_data, load_price_store, store_path
+from pricing import cluster_variant
+
+from settings import ROOT_DIR
+
+CUBE_VERSION = 1
+CUBE_DAYS = 15
+PERCENTILES = (10, 25, 50, 75, 90)
+SCORE_DAYS = (0, 7, 14)
+
+
+def cube_path(root_dir: str, league: str) -> str:
+    return os.path.join(root_dir, 'data', league, f'{league}.cube.npz')
+
+
+def _decode(store: PriceStore, column: str, codes: np.ndarray) -> np.ndarray:
+    return pd.Series(store.dictionaries[column][codes]).fillna('').to_numpy(dtype=str)
+
+
+def build_cube(store: PriceStore, days: int = CUBE_DAYS) -> dict:
+    # One price per (item, day): the median over every id listed for the item that day
+    rows = np.flatnonzero(np.asarray(store.columns['date']) < days)
+    df = pd.DataFrame({column: np.asarray(store.columns[column])[rows] for column in SUMMARY_KEYS + ('date', 'value')})
+    daily = df.groupby(list(SUMMARY_KEYS) + ['date'], sort=True)['value'].median() \
+        .unstack('date') \
+        .reindex(columns=range(days))
+    keys = daily.index.to_frame(index=False)
+    values = daily.to_numpy(dtype=np.float32)
+
+    # Volatility is the standard deviation of day-over-day log returns, gaps in the listings are skipped
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        volatility = np.nanstd(np.diff(np.log(values), axis=1), axis=1).astype(np.float32)
+
+    # Keys are decoded since every league's store has its own dictionaries
+    return {
+        'name': _decode(store, 'name', keys['name'].to_numpy()),
+        'links': _decode(store, 'links', keys['links'].to_numpy()),
+        'variant': _decode(store, 'variant', keys['variant'].to_numpy()),
+        'item_level': keys['item_level'].to_numpy(dtype=np.int8),
+        'values': values,
+        'volatility': volatility
+    }
+
+
+class LeagueCube:
+    def __init__(self, league: str, arrays: dict, meta: dict):
+        self.league = league
+        self.meta = meta
+        self.name = arrays['name']
+        self.links = arrays['links']
+        self.variant = arrays['variant']
+        self.item_level = arrays['item_level']
+        self.values = arrays['values']
+        self.volatility = arrays['volatility']
+        self.groups = pd.Series(np.arange(len(self.name))).groupby(self.name).indices
+        observed = ~np.isnan(self.values)
+        self.first_day = np.where(observed.any(axis=1), observed.argmax(axis=1), self.values.shape[1])
+
+    @classmethod
+    def load(cls, path: str) -> 'LeagueCube':
+        with np.load(path) as cube_file:
+            arrays = {name: cube_file[name] for name in cube_file.files}
+        meta = json.loads(str(arrays.pop('meta')))
+        return cls(meta['league'], arrays, meta)
+
+    @property
+    def days(self) -> int:
+        return self.values.shape[1]
+
+    def lookup(self, name: str, links: Optional[str] = None, variant: Optional[str] = None,
+               item_level: Optional[int] = None, below_item_level: Optional[int] = None) -> Optional[int]:
+        groups = self.groups.get(name)
+        if groups is None:
+            return None
+        for column, value in (('links', links), ('variant', variant), ('item_level', item_level)):
+            if value is not None:
+                groups = groups[getattr(self, column)[groups] == value]
+        if below_item_level is not None:
+            # Cluster jewels are priced at the highest listed item level below the jewel's own
+            groups = groups[(self.item_level[groups] >= 0) & (self.item_level[groups] < below_item_level)]
+            if groups.size:
+                groups = groups[self.item_level[groups] == self.item_level[groups].max()]
+        if not groups.size:
+            return None
+        # Several link/variant groups may match, use the one observed first as PriceStore.summarise does
+        return int(groups[np.argmin(self.first_day[groups])])
+
+
+def write_cube(path: str, cube: dict, meta: dict):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as cube_file:
+        np.savez(cube_file, meta=np.array(json.dumps(meta)), **cube)
+    os.replace(tmp_path, path)
+
+
+def load_cube(root_dir: str, league: str, store: Optional[PriceStore] = None) -> Optional[LeagueCube]:
+    path = cube_path(root_dir, league)
+    store_dir = store_path(root_dir, league)
+    source = os.path.basename(os.path.realpath(store_dir)) if os.path.isdir(store_dir) else None
+    if os.path.isfile(path):
+        try:
+            cube = LeagueCube.load(path)
+            # A cube outlives its raw rows, it is only rebuilt when a newer store generation exists
+            if cube.meta.get('version') == CUBE_VERSION and (source is None or cube.meta.get('source') == source):
+                return cube
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Could not read analytics cube '%s': %s", path, e)
+
+    if not (store := store or load_price_store(root_dir, league)):
+        return None
+    cube = build_cube(store)
+    meta = {
+        'version': CUBE_VERSION,
+        'league': league,
+        'source': os.path.basename(store.store_dir),
+        'start_date': str(store.start_date)
+    }
+    write_cube(path, cube, meta)
+    logging.info("Wrote analytics cube for %s with %d items", league, len(cube['name']))
+    return LeagueCube(league, cube, meta)
+
+
+def build_items(build: Build) -> list:
+    items = [(unique.name, {}) for unique in build.uniques]
+    items += [(cluster.small_passives, {'variant': cluster_variant(cluster), 'below_item_level': cluster.level}) for cluster in build.clusters]
+    return items
+
+
+class AnalyticsCube:
+    def __init__(self, root_dir: str, leagues: Optional[list] = None):
+        data_dir = os.path.join(root_dir, 'data')
+        if leagues is None:
+            # Only league folders, a cube outlives the league's raw rows so it counts on its own
+            entries = os.listdir(data_dir) if os.path.isdir(data_dir) else []
+            leagues = sorted(league for league in entries if has_price_data(root_dir, league) or os.path.isfile(cube_path(root_dir, league)))
+        self.cubes = {league: cube for league in leagues if (cube := load_cube(root_dir, league))}
+
+    @property
+    def leagues(self) -> list:
+        return list(self.cubes)
+
+    def _frame(self, rows: dict) -> pd.DataFrame:
+        days = max((cube.days for cube in self.cubes.values()), default=CUBE_DAYS)
+        return pd.DataFrame.from_dict(rows, orient='index', columns=range(days)).rename_axis(index='league', columns='day')
+
+    def item_trajectories(self, name: str, **criteria) -> pd.DataFrame:
+        rows = {}
+        for league, cube in self.cubes.items():
+            if (group := cube.lookup(name, **criteria)) is not None:
+                rows[league] = cube.values[group]
+        return self._frame(rows)
+
+    def build_trajectories(self, items: list) -> pd.DataFrame:
+        # An item's last known price carries forward over days it was not listed
+        rows = {}
+        for league, cube in self.cubes.items():
+            groups = [group for name, criteria in items if (group := cube.lookup(name, **criteria)) is not None]
+            if groups:
+                rows[league] = pd.DataFrame(cube.values[groups]).ffill(axis=1).sum(axis=0, min_count=1).to_numpy()
+        return self._frame(rows)
+
+    def cost_percentiles(self, percentiles: tuple = PERCENTILES) -> pd.DataFrame:
+        frames = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for league, cube in self.cubes.items():
+                frames[league] = pd.DataFrame(np.nanpercentile(cube.values, percentiles, axis=0), index=pd.Index(percentiles, name='percentile'))
+        return pd.concat(frames, names=['league']).rename_axis(columns='day')
+
+    def item_volatility(self, name: str, **criteria) -> pd.Series:
+        return pd.Series({league: float(cube.volatility[group]) for league, cube in self.cubes.items()
+                          if (group := cube.lookup(name, **criteria)) is not None}, name='volatility', dtype=np.float64)
+
+    def starter_scores(self, items: list) -> pd.DataFrame:
+        trajectories = self.build_trajectories(items)
+        scores = pd.DataFrame(index=trajectories.index)
+        for day in SCORE_DAYS:
+            scores[f'day_{day}_cost'] = trajectories[day] if day in trajectories else np.nan
+        first, last = scores[f'day_{SCORE_DAYS[0]}_cost'], scores[f'day_{SCORE_DAYS[-1]}_cost']
+        scores['change_pct'] = (last - first) / first * 100
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores['volatility'] = np.log(trajectories).diff(axis=1).std(axis=1)
+        scores['items_priced'] = pd.Series({league: sum(cube.lookup(name, **criteria) is not None for name, criteria in items)
+                                            for league, cube in self.cubes.items()})
+        return scores
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Compare how builds and item prices evolved over the first weeks of every ingested league")
+    parser.add_argument('builds', nargs='*', help="PoB links or build codes to score, prints cost percentiles when omitted")
+    parser.add_argument('-l', '--leagues', help="Comma separated leagues, defaults to every league under data/")
+    args = parser.parse_args(argv)
+
+    cube = AnalyticsCube(ROOT_DIR, args.leagues.split(',') if args.leagues else None)
+    if not cube.leagues:
+        logging.error("No league data found")
+        return 1
+    if not args.builds:
+        print(cube.cost_percentiles().round(1).to_string())
+        return 0
+
+    urls = [source for source in args.builds if validators.url(source)]
+    codes = dict(zip(urls, fetch_pob_codes(urls)))
+    for source in args.builds:
+        if not (build := parse_build(codes.get(source, source))):
+            logging.error("Could not load build '%s'", source)
+            continue
+        print(source)
+        print(cube.starter_scores(build_items(build)).round(2).to_string(), end='\n\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
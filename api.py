@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import validators
+import numpy as np
+import pandas as pd
+from typing import Optional
+from dataclasses import asdict
+
+from cache import LRUCache
+from metrics import timed
+from buildcache import get_build, build_hash
+from leagues import LeagueRegistry
+from pobutils import get_pob_code_from_url
+from pricing import AuditResult
+
+API_CACHE_SIZE = 4096
+API_CACHE_BYTES = 32 * 1024 * 1024
+API_MAX_LEAGUES = 8
+
+# Keyed by ETag, which covers the request and the store generation of every league it read
+response_cache = LRUCache(maxsize=API_CACHE_SIZE, maxbytes=API_CACHE_BYTES, name='api')
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def data_version(registry: LeagueRegistry, league: str) -> str:
+    if not (store := registry.store(league)):
+        raise ApiError(404, f"No price data for league '{league}'")
+    return os.path.basename(store.store_dir)
+
+
+def make_etag(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, separators=(',', ':'), default=str).encode()).hexdigest()[:32]
+
+
+def compact_json(record) -> bytes:
+    return json.dumps(record, separators=(',', ':'), default=str).encode()
+
+
+def _drop_none(record: dict) -> dict:
+    return {key: value for key, value in record.items() if value is not None}
+
+
+def audit_record(result: AuditResult) -> dict:
+    # Only the fields a client needs, unpriced items are reported by name alone
+    record = {
+        'unique_total': result.unique_total,
+        'cluster_total': result.cluster_total,
+        'week1_total': round(result.week1_total, 2),
+        'window_median_total': round(result.window_median, 2),
+        'window_p90_total': round(result.window_p90, 2)
+    }
+    for kind in ('uniques', 'clusters'):
+        record[kind] = [_drop_none(dict(asdict(item), lookup_name=None if item.lookup_name == item.name else item.lookup_name,
+                                        week1_price=item.week1_price and round(item.week1_price, 2),
+                                        week1_change=item.week1_change and round(item.week1_change, 2),
+                                        window_median=item.window_median and round(item.window_median, 2),
+                                        window_p90=item.window_p90 and round(item.window_p90, 2)))
+                        for item in getattr(result, kind)]
+    return record
+
+
+def price_history(store, name: str, criteria: dict, start: Optional[str] = None, end: Optional[str] = None) -> list:
+    # One point per day, the median over every id matching the criteria
+    rows = store.select(name=name, **criteria)
+    if not rows.size:
+        return []
+    history = pd.Series(np.asarray(store.columns['value'][rows], dtype=np.float64)) \
+        .groupby(np.asarray(store.columns['date'][rows])).median()
+    dates = store.start_date + history.index.to_numpy().astype('timedelta64[D]')
+    keep = np.ones(len(dates), dtype=bool)
+    if start:
+        keep &= dates >= np.datetime64(start, 'D')
+    if end:
+        keep &= dates <= np.datetime64(end, 'D')
+    return [[str(day), round(value, 2)] for day, value in zip(dates[keep], history.to_numpy()[keep].tolist())]
+
+
+def register_api(server, registry: LeagueRegistry, default_league: str):
+    from flask import Response, request
+
+    def leagues_from(value) -> list:
+        if not value:
+            return [default_league]
+        leagues = value if isinstance(value, list) else [league for league in str(value).split(',') if league]
+        if not all(isinstance(league, str) for league in leagues):
+            raise ApiError(400, "Leagues must be names")
+        if len(leagues) > API_MAX_LEAGUES:
+            raise ApiError(400, f"At most {API_MAX_LEAGUES} leagues per request")
+        return leagues
+
+    def respond(etag: str, compute) -> Response:
+        # Conditional GETs are answered before any work is done, other hits are served from the cache
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if request.method in ('GET', 'HEAD') and request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if (body := response_cache.get(etag)) is None:
+            body = compact_json(compute())
+            response_cache.set(etag, body)
+        return Response(body, mimetype='application/json', headers=headers)
+
+    @server.errorhandler(ApiError)
+    def api_error(error: ApiError):
+        return Response(compact_json({'error': str(error)}), status=error.status, mimetype='application/json')
+
+    @server.route('/api/audit', methods=['GET', 'POST'])
+    @timed('lsa_api_seconds', endpoint='audit')
+    def api_audit():
+        params = request.get_json(silent=True)
+        if params is None:
+            params = request.values
+        elif not isinstance(params, dict):
+            raise ApiError(400, "Expected a JSON object")
+        pob_input = params.get('build') or (request.get_data(as_text=True) if request.mimetype == 'text/plain' else '')
+        if not isinstance(pob_input, str) or not (pob_input := pob_input.strip()):
+            raise ApiError(400, "Expected a PoB link or build code in 'build'")
+        leagues = leagues_from(params.get('leagues') or params.get('league'))
+        pob_code = get_pob_code_from_url(pob_input) if validators.url(pob_input) else pob_input
+        if not pob_code:
+            raise ApiError(422, "Could not fetch a build code from the given link")
+
+        pob_hash = build_hash(pob_code)
+        versions = {league: data_version(registry, league) for league in leagues}
+
+        def compute() -> dict:
+            if not (build := get_build(pob_code)):
+                raise ApiError(422, "Could not decode build code")
+            return {
+                'build': pob_hash,
+                'character': build.character,
+                'display_stats': build.display_stats,
+                'leagues': {league: dict(audit_record(registry.engine(league).audit_build(build)), version=version)
+                            for league, version in versions.items()}
+            }
+        return respond(make_etag('audit', pob_hash, versions), compute)
+
+    @server.route('/api/price/<path:item>', methods=['GET'])
+    @timed('lsa_api_seconds', endpoint='price')
+    def api_price(item: str):
+        league = request.args.get('league') or default_league
+        version = data_version(registry, league)
+        criteria = {key: request.args[key] for key in ('links', 'variant') if request.args.get(key)}
+        if request.args.get('item_level'):
+            try:
+                criteria['item_level'] = int(request.args['item_level'])
+            except ValueError:
+                raise ApiError(400, "item_level must be an integer")
+        start, end = request.args.get('start'), request.args.get('end')
+        for bound in (start, end):
+            if bound:
+                try:
+                    np.datetime64(bound, 'D')
+                except ValueError:
+                    raise ApiError(400, f"Expected an ISO date, got '{bound}'")
+
+        def compute() -> dict:
+            store = registry.store(league)
+            if not (history := price_history(store, item, criteria, start, end)):
+                raise ApiError(404, f"No prices for '{item}' in {league}")
+            summary = store.summarise(item, **criteria)
+            return {
+                'item': item,
+                'league': league,
+                'version': version,
+                'criteria': criteria,
+                'first_price': round(summary.first_value, 2) if summary else None,
+                'first_seen': summary.first_date.isoformat() if summary else None,
+                'history': history
+            }
+        return respond(make_etag('price', item, league, version, criteria, start, end), compute)
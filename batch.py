@@ -0,0 +1,142 @@
+import os
+import csv
+import sys
+import json
+import time
+import logging
+import argparse
+import validators
+import multiprocessing
+from typing import Optional
+
+from fetcher import fetch_pob_codes
+from pobutils import parse_build
+from pricestore import PriceStore, load_price_store, store_path
+from pricing import AuditResult, audit_build, audit_to_dict
+
+from settings import LEAGUE, ROOT_DIR
+
+BATCH_CHUNK_SIZE = 8
+PROGRESS_INTERVAL = 100
+CSV_FIELDS = ['source', 'character', 'unique_cost', 'cluster_cost', 'day_7_cost', 'day_0_7_median_cost', 'day_0_7_p90_cost', 'items', 'error']
+
+_store = None
+
+
+def audit_to_row(result: AuditResult) -> dict:
+    record = audit_to_dict(result)
+    items = [dict(item, kind='unique') for item in record['uniques']] + [dict(item, kind='cluster') for item in record['clusters']]
+    return {
+        'character': f"Level {result.character.get('level')} {result.character.get('class')}",
+        'unique_cost': result.unique_total,
+        'cluster_cost': result.cluster_total,
+        'day_7_cost': round(result.week1_total),
+        'day_0_7_median_cost': round(result.window_median),
+        'day_0_7_p90_cost': round(result.window_p90),
+        'items': items
+    }
+
+
+def _init_worker(store_dir: str):
+    global _store
+    # Forked workers inherit the parent's memory-mapped store, others map the same files
+    if _store is None:
+        _store = PriceStore(store_dir)
+
+
+def _audit(job: tuple) -> dict:
+    source, pob_code = job
+    row = {'source': source}
+    if not pob_code:
+        row['error'] = 'Could not fetch build code'
+        return row
+    build = parse_build(pob_code)
+    if not build:
+        row['error'] = 'Could not decode build code'
+        return row
+    row.update(audit_to_row(audit_build(_store, build)))
+    return row
+
+
+def read_sources(file_name: str) -> list:
+    with open(file_name, 'r', encoding='utf-8') as sources_file:
+        return [line.strip() for line in sources_file if line.strip() and not line.startswith('#')]
+
+
+def resolve_codes(sources: list, concurrency: Optional[int] = None) -> list:
+    urls = [source for source in sources if validators.url(source)]
+    codes = dict(zip(urls, fetch_pob_codes(urls, concurrency))) if urls else {}
+    return [(source, codes.get(source, source)) for source in sources]
+
+
+class RowWriter:
+    def __init__(self, out_file, output_format: str):
+        self.out_file = out_file
+        self.output_format = output_format
+        if output_format == 'csv':
+            self.writer = csv.DictWriter(out_file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, row: dict):
+        if self.output_format == 'csv':
+            self.writer.writerow(dict(row, items=json.dumps(row.get('items', []))))
+        else:
+            self.out_file.write(json.dumps(row) + '\n')
+        self.out_file.flush()
+
+
+def run_batch(sources: list, store_dir: str, out_file, output_format: str = 'csv', workers: Optional[int] = None,
+              concurrency: Optional[int] = None) -> dict:
+    global _store
+    start = time.perf_counter()
+    jobs = resolve_codes(sources, concurrency)
+    logging.info("Resolved %d build codes in %0.2fs", len(jobs), time.perf_counter() - start)
+
+    _store = PriceStore(store_dir)
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    writer = RowWriter(out_file, output_format)
+    failed = 0
+    with context.Pool(processes=workers, initializer=_init_worker, initargs=(store_dir,)) as pool:
+        for done, row in enumerate(pool.imap(_audit, jobs, chunksize=BATCH_CHUNK_SIZE), start=1):
+            writer.write(row)
+            failed += 'error' in row
+            if done % PROGRESS_INTERVAL == 0 or done == len(jobs):
+                logging.info("Audited %d/%d builds", done, len(jobs))
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        'builds': len(jobs),
+        'failed': failed,
+        'seconds': elapsed,
+        'builds_per_second': len(jobs) / elapsed if elapsed else 0.0
+    }
+    logging.info("Audited %d builds (%d failed) in %0.2fs, %0.1f builds/s", stats['builds'], failed, elapsed, stats['builds_per_second'])
+    return stats
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Price a file of PoB links or build codes against a league's early economy")
+    parser.add_argument('input', help="File with one pastebin/pobb.in link or build code per line")
+    parser.add_argument('-o', '--output', help="Output file, defaults to stdout")
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'], default='csv')
+    parser.add_argument('-l', '--league', default=LEAGUE)
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('-c', '--concurrency', type=int, help="Number of links fetched at once")
+    args = parser.parse_args(argv)
+
+    if not load_price_store(ROOT_DIR, args.league):
+        logging.error("Data file not found for %s, exiting...", args.league)
+        return 1
+
+    sources = read_sources(args.input)
+    out_file = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        run_batch(sources, os.path.realpath(store_path(ROOT_DIR, args.league)), out_file, args.format, args.workers, args.concurrency)
+    finally:
+        if args.output:
+            out_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
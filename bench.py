@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+import psutil
+import numpy as np
+import pandas as pd
+from typing import Optional
+from datetime import date, timedelta, datetime
+
+import graphs
+from pobutils import DATA_READ_OPTIONS, load_data, iter_data, read_pob_to_xml, get_uniques_from_xml, get_clusters_from_xml, get_stats_from_xml, parse_build
+from clusterids import LEVELS_SUFFIX, write_cluster_levels, load_cluster_levels, cluster_item_levels
+from pricestore import PriceStore, build_price_store
+from pricing import audit_build
+
+# One scale unit is roughly a full league dump: ~30k item ids priced daily for 90 days
+SYNTHETIC_IDS = 30_000
+SYNTHETIC_DAYS = 90
+SYNTHETIC_START = date(2023, 12, 8)
+CLUSTER_SIZES = {'Large Cluster Jewel': (8, 12), 'Medium Cluster Jewel': (4, 6), 'Small Cluster Jewel': (2, 3)}
+CLUSTER_LEVELS = (1, 50, 68, 75, 84)
+CORPUS_SHAPES = ((4, 0), (12, 4), (20, 21), (40, 40))
+# How load_data read the dump before every column was typed, kept as the memory baseline
+PREVIOUS_READ_OPTIONS = {
+    'delimiter': ';',
+    'parse_dates': ['Date'],
+    'dtype': {'Type': 'category', 'BaseType': 'category', 'Variant': 'category', 'Links': 'category', 'Confidence': 'category'},
+    'usecols': DATA_READ_OPTIONS['usecols']
+}
+COMPACT_CHUNK_SIZE = 200_000
+SYNTHETIC_ITEM_SETS = 20
+SYNTHETIC_MODS = ('{{tags:life}}{{range:0.5}}+{} to maximum Life', '{{tags:resistance}}+{}% to Fire Resistance', '{{tags:resistance}}+{}% to Cold Resistance',
+                  '{{crafted}}{}% increased Attack Speed', '{{fractured}}Adds {} to 40 Physical Damage to Attacks', '{{range:0.7}}{}% increased Energy Shield',
+                  '+{} to Strength', '+{} to Intelligence', '{}% increased Rarity of Items found', '{{tags:mana}}+{} to maximum Mana')
+REGRESSION_THRESHOLD = 1.2
+
+
+def _small_passive(index: int) -> str:
+    return f'{index % 40 + 5}% increased Synthetic Damage {index}'
+
+
+def write_synthetic_dump(data_dir: str, league: str, scale: float, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    num_ids = max(int(SYNTHETIC_IDS * scale), 10)
+    num_clusters = num_ids // 10
+    num_uniques = num_ids - num_clusters
+
+    unique_names = np.array([f'Synthetic Unique {i // 3}' for i in range(num_uniques)], dtype=object)
+    unique_links = np.where(np.arange(num_uniques) % 3 == 1, '6L', np.where(np.arange(num_uniques) % 3 == 2, '5L', ''))
+    sizes = list(CLUSTER_SIZES)
+    cluster_sizes = np.array([sizes[i % len(sizes)] for i in range(num_clusters)], dtype=object)
+    cluster_passives = np.array([f'{CLUSTER_SIZES[size][i % 2]} passives' for i, size in enumerate(cluster_sizes)], dtype=object)
+    cluster_names = np.array([_small_passive(i // (2 * len(CLUSTER_LEVELS))) for i in range(num_clusters)], dtype=object)
+    cluster_levels = np.array([CLUSTER_LEVELS[i % len(CLUSTER_LEVELS)] for i in range(num_clusters)])
+
+    items = pd.DataFrame({
+        'Id': np.arange(num_ids),
+        'Type': np.r_[np.full(num_uniques, 'UniqueArmour', dtype=object), np.full(num_clusters, 'ClusterJewel', dtype=object)],
+        'Name': np.r_[unique_names, cluster_names],
+        'BaseType': np.r_[np.full(num_uniques, 'Synthetic Base', dtype=object), cluster_sizes],
+        'Variant': np.r_[np.full(num_uniques, '', dtype=object), cluster_passives],
+        'Links': np.r_[unique_links, np.full(num_clusters, '', dtype=object)],
+        'Base': rng.lognormal(3, 1.5, num_ids)
+    })
+
+    os.makedirs(os.path.join(data_dir, league), exist_ok=True)
+    items_file = os.path.join(data_dir, league, f'{league}.items.csv')
+    cluster_ids_file = os.path.join(data_dir, league, f'{league}{LEVELS_SUFFIX}')
+    rows = 0
+    with open(items_file, 'w', encoding='utf-8', newline='') as out_file:
+        out_file.write('League;Date;Id;Type;Name;BaseType;Variant;Links;Value;Confidence\n')
+        for day in range(SYNTHETIC_DAYS):
+            # Items drift in price from day to day and some are not listed every day
+            listed = items.loc[rng.random(num_ids) < 0.9]
+            frame = pd.DataFrame({
+                'League': league,
+                'Date': (SYNTHETIC_START + timedelta(days=day)).isoformat(),
+                'Id': listed['Id'],
+                'Type': listed['Type'],
+                'Name': listed['Name'],
+                'BaseType': listed['BaseType'],
+                'Variant': listed['Variant'],
+                'Links': listed['Links'],
+                'Value': np.round(listed['Base'].to_numpy() * rng.lognormal(0, 0.1, len(listed)) / (1 + day / 30), 2),
+                'Confidence': rng.choice(['High', 'Medium', 'Low'], len(listed))
+            })
+            frame.to_csv(out_file, sep=';', header=False, index=False)
+            rows += len(frame)
+    write_cluster_levels(cluster_ids_file, np.arange(num_uniques, num_ids), cluster_levels)
+    return items_file, cluster_ids_file, rows
+
+
+def synthetic_pob_code(num_uniques: int, num_clusters: int, seed: int = 0, scale: float = 1) -> str:
+    rng = random.Random(seed)
+    num_unique_names = max(int(SYNTHETIC_IDS * scale), 10) * 9 // 10 // 3
+    items = []
+    # Shaped like a real export: full mod lines, several item sets, and the sections the auditor never reads
+    for i in range(num_uniques):
+        items.append('\n'.join([
+            'Rarity: UNIQUE', f'Synthetic Unique {rng.randrange(num_unique_names)}', 'Synthetic Base', f'Unique ID: {rng.getrandbits(128):032x}',
+            'Item Level: 84', 'Quality: 20', 'Sockets: R-R-G-B', 'LevelReq: 60', 'Implicits: 1', '{tags:life}+25 to maximum Life'
+        ] + [rng.choice(SYNTHETIC_MODS).format(rng.randint(10, 99)) for _ in range(rng.randint(6, 12))]))
+    for i in range(num_clusters):
+        size = rng.choice(list(CLUSTER_SIZES))
+        items.append('\n'.join([
+            'Rarity: RARE', 'Synthetic Cluster', size, f'Unique ID: {rng.getrandbits(128):032x}', f'Item Level: {rng.choice(CLUSTER_LEVELS) + 1}',
+            'LevelReq: 54', 'Implicits: 3', f'{{crafted}}Adds {CLUSTER_SIZES[size][i % 2]} Passive Skills', '{crafted}1 Added Passive Skill is a Jewel Socket',
+            f'{{crafted}}Added Small Passive Skills grant: {_small_passive(rng.randrange(max(int(SYNTHETIC_IDS * scale) // 100, 1)))}',
+            '1 Added Passive Skill is Burning Bright', '1 Added Passive Skill is Smoking Remains'
+        ]))
+    for i in range(num_uniques):
+        items.append('\n'.join([
+            'Rarity: RARE', 'Synthetic Rare', 'Vaal Regalia', f'Unique ID: {rng.getrandbits(128):032x}', 'Item Level: 86', 'Quality: 20',
+            'Sockets: B-B-B-B-B-B', 'LevelReq: 68', 'Implicits: 0'
+        ] + [rng.choice(SYNTHETIC_MODS).format(rng.randint(10, 99)) for _ in range(rng.randint(6, 12))]))
+    item_xml = ''.join(f'<Item id="{i + 1}">\n{text}\n</Item>' for i, text in enumerate(items))
+    sets_xml = ''.join(f'<ItemSet useSecondWeaponSet="nil" id="{s}">' + ''.join(f'<Slot itemPbURL="" name="Slot {i}" itemId="{i + 1}"/>' for i in range(len(items))) + '</ItemSet>'
+                       for s in range(1, SYNTHETIC_ITEM_SETS + 1))
+    stats_xml = ''.join(f'<PlayerStat stat="Stat{i}" value="{i}.5"/>' for i in range(250)) + '<PlayerStat stat="Life" value="5000"/><FullDPSSkill stat="Synthetic Skill" value="123456"/>'
+    skills_xml = '<Skills>' + ''.join('<Skill enabled="true" slot="Body Armour" mainActiveSkill="1">' + ''.join(
+        f'<Gem level="20" quality="20" skillId="SyntheticGem{g}" nameSpec="Synthetic Gem {g}" enabled="true"/>' for g in range(6)) + '</Skill>' for _ in range(12)) + '</Skills>'
+    tree_xml = '<Tree activeSpec="1"><Spec treeVersion="3_23" nodes="' + ','.join(str(rng.randrange(65000)) for _ in range(120)) + '"><Sockets/></Spec></Tree>'
+    config_xml = '<Config>' + ''.join(f'<Input name="synthetic{i}" boolean="true"/>' for i in range(60)) + '</Config>'
+    xml = (f'<?xml version="1.0" encoding="UTF-8"?>\n<PathOfBuilding><Build level="95" className="Witch" ascendClassName="Elementalist">{stats_xml}</Build>'
+           f'{skills_xml}{tree_xml}<Notes>Synthetic build</Notes><Items activeItemSet="1">{item_xml}{sets_xml}</Items>{config_xml}</PathOfBuilding>')
+    return base64.urlsafe_b64encode(zlib.compress(xml.encode())).decode()
+
+
+def _reset_peak_rss():
+    # A forked child inherits the parent's resident set and its high-water mark, writing 5 to clear_refs
+    # (Linux 4.0+) resets the mark to the current RSS so ru_maxrss only grows with what the stage allocates
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _run_stage(stage, repeat: int, conn):
+    _reset_peak_rss()
+    start_rss = psutil.Process().memory_info().rss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - start)
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    conn.send({'timings': timings, 'start_rss_bytes': start_rss, 'peak_rss_bytes': peak_rss})
+    conn.close()
+
+
+def measure(name: str, stage, repeat: int, **labels) -> dict:
+    # Every stage runs in a forked child, which starts out sharing the parent's frames, stores and builds,
+    # so a stage's memory is the growth of the child's peak RSS over its RSS when the stage started
+    context = multiprocessing.get_context('fork')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage, args=(stage, repeat, child_conn))
+    process.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    process.join()
+    timings = result['timings']
+    record = dict(labels, stage=name, repeat=repeat, min_s=min(timings), median_s=statistics.median(timings),
+                  mean_s=statistics.fmean(timings), start_rss_bytes=result['start_rss_bytes'], peak_rss_bytes=result['peak_rss_bytes'],
+                  rss_increase_bytes=max(result['peak_rss_bytes'] - result['start_rss_bytes'], 0))
+    logging.info("%-20s %s median %8.4fs  RSS +%6.0f MB (from %6.0f MB)", name, labels, record['median_s'],
+                 record['rss_increase_bytes'] / 2 ** 20, record['start_rss_bytes'] / 2 ** 20)
+    return record
+
+
+def frame_memory(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def load_previous_data(items_file: str, cluster_ids_file: str) -> pd.DataFrame:
+    df = pd.read_csv(items_file, **PREVIOUS_READ_OPTIONS)
+    df['Links'] = df['Links'].cat.add_categories('None').fillna('None')
+    table = load_cluster_levels(cluster_ids_file)
+    return df.merge(pd.DataFrame({'Id': table[:, 0], 'ItemLevel': table[:, 1]}), on='Id', how='left')
+
+
+def concat_categorical(frames: list) -> pd.DataFrame:
+    # Chunks are read with their own categories, which pd.concat would otherwise fall back to object dtype for
+    for column in frames[0].select_dtypes('category').columns:
+        categories = frames[0][column].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[column].cat.categories)
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_compact_data(items_file: str, cluster_ids_file: str, chunksize: int = COMPACT_CHUNK_SIZE) -> pd.DataFrame:
+    # The layout the price store writes: int16 day offsets from the league start and an Int8 item level.
+    # Every chunk is compacted as it is read, so the wide parsed chunks never coexist with the result.
+    table = load_cluster_levels(cluster_ids_file)
+    chunks = []
+    for chunk in iter_data(items_file, chunksize):
+        item_levels = pd.array(cluster_item_levels(table, chunk['Id'].to_numpy(), chunk['Type'].to_numpy()), dtype='Int8')
+        item_levels[item_levels < 0] = pd.NA
+        # Days since the epoch fit in int16 until 2059, the league start is subtracted once every chunk is in
+        chunks.append(chunk.assign(Date=chunk['Date'].to_numpy(dtype='datetime64[D]').astype(np.int16), ItemLevel=item_levels))
+    df = concat_categorical(chunks)
+    del chunks
+    start_day = int(df['Date'].min())
+    df['Date'] -= np.int16(start_day)
+    df.attrs['start_date'] = np.datetime64(start_day, 'D')
+    # Rows sorted by (Name, Date) like the store's columns, so one item's history is a contiguous slice
+    df = df.take(np.lexsort((df['Date'].to_numpy(), df['Name'].cat.codes.to_numpy())))
+    df.index = pd.RangeIndex(len(df))
+    return df
+
+
+def memory_report(items_file: str, cluster_ids_file: str, repeat: int, labels: dict) -> tuple:
+    previous = measure('load_previous_data', lambda: load_previous_data(items_file, cluster_ids_file), repeat, **labels)
+    compact = measure('load_compact_data', lambda: load_compact_data(items_file, cluster_ids_file), repeat, **labels)
+    previous['frame_bytes'] = frame_memory(load_previous_data(items_file, cluster_ids_file))
+    compact['frame_bytes'] = frame_memory(load_compact_data(items_file, cluster_ids_file))
+    logging.info("Compaction %s: frame %0.1f MB -> %0.1f MB (x%0.1f), RSS increase %0.0f MB -> %0.0f MB (x%0.1f)", labels,
+                 previous['frame_bytes'] / 2 ** 20, compact['frame_bytes'] / 2 ** 20, previous['frame_bytes'] / compact['frame_bytes'],
+                 previous['rss_increase_bytes'] / 2 ** 20, compact['rss_increase_bytes'] / 2 ** 20,
+                 previous['rss_increase_bytes'] / max(compact['rss_increase_bytes'], 1))
+    return previous, compact
+
+
+def run_benchmarks(work_dir: str, scales: list, repeat: int) -> list:
+    results = []
+    for scale in scales:
+        league = f'Bench{str(scale).replace(".", "_")}'
+        items_file, cluster_ids_file, rows = write_synthetic_dump(os.path.join(work_dir, 'data'), league, scale)
+        store_dir = os.path.join(work_dir, 'data', league, f'{league}.store')
+        labels = {'scale': scale, 'rows': rows}
+
+        results.extend(memory_report(items_file, cluster_ids_file, repeat, labels))
+        df = load_data(items_file)
+        results.append(measure('cluster_join', lambda df=df: cluster_item_levels(load_cluster_levels(cluster_ids_file), df['Id'].to_numpy(), df['Type'].to_numpy()), repeat, **labels))
+        del df
+        # The store written by the measured child stays on disk for the stages below
+        results.append(measure('build_price_store', lambda: build_price_store(items_file, cluster_ids_file, store_dir), 1, **labels))
+        results.append(measure('open_price_store', lambda: PriceStore(os.path.realpath(store_dir)), repeat, **labels))
+        store = PriceStore(os.path.realpath(store_dir))
+
+        for num_uniques, num_clusters in CORPUS_SHAPES:
+            corpus = [synthetic_pob_code(num_uniques, num_clusters, seed, scale) for seed in range(20)]
+            corpus_labels = dict(labels, uniques=num_uniques, clusters=num_clusters, builds=len(corpus))
+            roots = [read_pob_to_xml(code) for code in corpus]
+            builds = [parse_build(code) for code in corpus]
+            results.append(measure('read_pob_to_xml', lambda: [read_pob_to_xml(code) for code in corpus], repeat, **corpus_labels))
+            results.append(measure('xml_extractors', lambda: [(get_uniques_from_xml(root), get_clusters_from_xml(root), get_stats_from_xml(root)) for root in roots], repeat, **corpus_labels))
+            results.append(measure('parse_build', lambda: [parse_build(code) for code in corpus], repeat, **corpus_labels))
+            results.append(measure('audit_build', lambda: [audit_build(store, build) for build in builds], repeat, **corpus_labels))
+
+        names = [f'Synthetic Unique {i}' for i in range(20)]
+
+        def unique_figures():
+            graphs.figure_cache.clear()
+            return [graphs.unique_figure(store, name, '6L') for name in names]
+        results.append(measure('unique_figure', unique_figures, repeat, **dict(labels, figures=len(names))))
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_file: str, threshold: float = REGRESSION_THRESHOLD) -> list:
+    with open(baseline_file, 'r', encoding='utf-8') as baseline:
+        previous = {_result_key(result): result for result in json.load(baseline)['results']}
+    regressions = []
+    for result in results:
+        if (before := previous.get(_result_key(result))) and before['median_s'] > 0:
+            ratio = result['median_s'] / before['median_s']
+            if ratio > threshold:
+                regressions.append(dict(result, baseline_median_s=before['median_s'], ratio=ratio))
+                logging.warning("Regression in %s %s: %0.4fs -> %0.4fs (x%0.2f)", result['stage'], _result_key(result)[1:], before['median_s'], result['median_s'], ratio)
+    return regressions
+
+
+def _result_key(result: dict) -> tuple:
+    return tuple((key, result[key]) for key in ('stage', 'scale', 'uniques', 'clusters') if key in result)
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the auditor's hot paths on synthetic poe.ninja dumps and PoB builds")
+    parser.add_argument('-s', '--scales', default='0.1,1', help="Comma separated dump sizes, 1 is roughly one full league")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help="Write results as JSON to this file")
+    parser.add_argument('-w', '--work-dir', help="Directory for the synthetic data, defaults to a temporary directory")
+    parser.add_argument('-c', '--compare', help="Previous results file to check for regressions")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='lsa-bench-')
+    started = datetime.now().isoformat(timespec='seconds')
+    results = run_benchmarks(work_dir, [float(scale) for scale in args.scales.split(',')], args.repeat)
+    report = {
+        'commit': _git_commit(),
+        'started': started,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as out_file:
+            json.dump(report, out_file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+    if args.compare and compare(results, args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
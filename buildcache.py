@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Optional
+from dataclasses import asdict
+
+from cache import LRUCache
+from metrics import metrics
+from pobutils import Build, UniqueItem, ClusterJewel, parse_build
+
+BUILD_CACHE_SIZE = 512
+BUILD_CACHE_DIR = os.environ.get('LSA_BUILD_CACHE_DIR')
+
+
+def build_hash(pob_code: str) -> str:
+    return hashlib.sha256(pob_code.strip().encode()).hexdigest()
+
+
+def build_to_dict(build: Build) -> dict:
+    return asdict(build)
+
+
+def build_from_dict(record: dict) -> Build:
+    character = dict(record['character'])
+    if 'FullDPSSkill' in character:
+        character['FullDPSSkill'] = [tuple(skill) for skill in character['FullDPSSkill']]
+    return Build(
+        uniques=[UniqueItem(**unique) for unique in record['uniques']],
+        clusters=[ClusterJewel(**cluster) for cluster in record['clusters']],
+        character=character,
+        display_stats=record['display_stats']
+    )
+
+
+class BuildCache:
+    def __init__(self, maxsize: int = BUILD_CACHE_SIZE, cache_dir: Optional[str] = BUILD_CACHE_DIR):
+        self.memory = LRUCache(maxsize=maxsize, name='build')
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _read(self, key: str) -> Optional[Build]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as build_file:
+                return build_from_dict(json.load(build_file))
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logging.error("Could not read cached build '%s': %s", key, e)
+            return None
+
+    def _write(self, key: str, build: Build):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so other workers never see a partial file
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as build_file:
+                json.dump(build_to_dict(build), build_file)
+            os.replace(tmp_path, path)
+        except OSError as ose:
+            logging.error("Could not write cached build '%s': %s", key, ose)
+
+    def get(self, pob_code: str) -> Optional[Build]:
+        if not pob_code:
+            return None
+        key = build_hash(pob_code)
+        if (build := self.memory.get(key)) is not None:
+            with self._lock:
+                self.hits += 1
+            return build
+        if self.cache_dir:
+            build = self._read(key)
+            metrics.inc('lsa_cache_requests_total', cache='build_disk', result='miss' if build is None else 'hit')
+            if build is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self.memory.set(key, build)
+                return build
+
+        with self._lock:
+            self.misses += 1
+        build = parse_build(pob_code)
+        if build is not None:
+            self.memory.set(key, build)
+            if self.cache_dir:
+                self._write(key, build)
+        return build
+
+    def stats(self) -> dict:
+        return {'size': len(self.memory), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+build_cache = BuildCache()
+
+
+def get_build(pob_code: str) -> Optional[Build]:
+    return build_cache.get(pob_code)
@@ -0,0 +1,74 @@
+import time
+import threading
+from typing import Optional
+from collections import OrderedDict
+
+from metrics import metrics
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, maxbytes: Optional[int] = None, sizeof=len, name: Optional[str] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and self.ttl is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if self.name:
+            metrics.inc('lsa_cache_requests_total', cache=self.name, result='miss' if entry is _MISSING else 'hit')
+        return default if entry is _MISSING else entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires, size)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, _MISSING)
+        if entry is not _MISSING:
+            self.nbytes -= entry[2]
+        return entry
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            return entry is not _MISSING and (entry[1] is None or entry[1] >= time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._entries)
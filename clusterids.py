@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import logging
+import requests
+import numpy as np
+from typing import Optional
+
+CLUSTER_IDS_URL = 'https://poe.ninja/api/data/itemoverview?league={league}&type=ClusterJewel&language=en'
+CLUSTER_IDS_TIMEOUT = (3.05, 30)
+CLUSTER_TYPE = 'ClusterJewel'
+LEVELS_SUFFIX = '.clusterjewels.levels.npy'
+LEGACY_IDS_SUFFIX = '.clusterjewels.ids.csv'
+
+
+def cluster_levels_path(root_dir: str, league: str) -> str:
+    return os.path.join(root_dir, f'data/{league}/{league}{LEVELS_SUFFIX}')
+
+
+def _meta_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.json'
+
+
+def write_cluster_levels(path: str, ids, levels):
+    # Kept as (id, item level) pairs sorted by id, so lookups are a single searchsorted
+    table = np.column_stack([np.asarray(ids, dtype=np.int32), np.asarray(levels, dtype=np.int32)])
+    table = table[np.argsort(table[:, 0], kind='stable')]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as levels_file:
+        np.save(levels_file, table)
+    os.replace(tmp_path, path)
+
+
+def _read_legacy_csv(csv_path: str) -> Optional[np.ndarray]:
+    # Earlier setups wrote the mapping as an Id,ItemLevel CSV, convert it on first use
+    try:
+        table = np.loadtxt(csv_path, delimiter=',', skiprows=1, dtype=np.float64, ndmin=2)
+    except (OSError, ValueError):
+        return None
+    table = table[~np.isnan(table).any(axis=1)].astype(np.int32)
+    return table[np.argsort(table[:, 0], kind='stable')]
+
+
+def load_cluster_levels(path: str) -> np.ndarray:
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        pass
+    if path.endswith(LEVELS_SUFFIX) and (table := _read_legacy_csv(path[:-len(LEVELS_SUFFIX)] + LEGACY_IDS_SUFFIX)) is not None:
+        write_cluster_levels(path, table[:, 0], table[:, 1])
+        return table
+    logging.error("Could not read cluster jewel item levels from '%s'", path)
+    return np.empty((0, 2), dtype=np.int32)
+
+
+def lookup_item_levels(table: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    # Unknown ids get -1, the store's marker for a missing item level
+    ids = np.asarray(ids)
+    if not len(table):
+        return np.full(len(ids), -1, dtype=np.int32)
+    positions = np.minimum(np.searchsorted(table[:, 0], ids), len(table) - 1)
+    return np.where(table[positions, 0] == ids, table[positions, 1], -1)
+
+
+def cluster_item_levels(table: np.ndarray, ids: np.ndarray, types: np.ndarray) -> np.ndarray:
+    # Only cluster jewel rows are looked up, every other row keeps -1
+    item_levels = np.full(len(ids), -1, dtype=np.int32)
+    clusters = np.asarray(types == CLUSTER_TYPE)
+    item_levels[clusters] = lookup_item_levels(table, np.asarray(ids)[clusters])
+    return item_levels
+
+
+def refresh_cluster_levels(url: str, path: str) -> bool:
+    # Conditional request, poe.ninja answers 304 when the mapping on disk is still current
+    meta_path = _meta_path(path)
+    headers = {}
+    if os.path.isfile(path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    try:
+        resp = requests.get(url, headers=headers, timeout=CLUSTER_IDS_TIMEOUT)
+    except requests.RequestException as rqe:
+        logging.error("Failed to fetch URL '%s': %s", url, rqe)
+        return False
+    if resp.status_code == 304:
+        logging.info("Cluster jewel item levels at '%s' are up to date", path)
+        return True
+    if resp.status_code != 200:
+        logging.error("Failed to fetch URL '%s', status %d", url, resp.status_code)
+        return False
+
+    try:
+        lines = resp.json()['lines']
+    except (ValueError, KeyError, TypeError):
+        logging.error("Could not decode cluster jewels JSON from '%s'", url)
+        return False
+    pairs = [(line['id'], line['levelRequired']) for line in lines if line.get('id') is not None and line.get('levelRequired') is not None]
+    write_cluster_levels(path, [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+    with open(meta_path, 'w', encoding='utf-8') as meta_file:
+        json.dump({'url': url, 'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}, meta_file)
+    logging.info("Wrote %d cluster jewel item levels to '%s'", len(pairs), path)
+    return True
+
+
+if __name__ == '__main__':
+    from settings import LEAGUE, ROOT_DIR
+    logging.basicConfig(level=logging.INFO)
+    league = sys.argv[1] if len(sys.argv) > 1 else LEAGUE
+    sys.exit(0 if refresh_cluster_levels(CLUSTER_IDS_URL.format(league=league), cluster_levels_path(ROOT_DIR, league)) else 1)
@@ -0,0 +1,112 @@
+import re
+import asyncio
+import logging
+import threading
+import requests
+from typing import Optional
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+
+from cache import LRUCache
+
+BUILD_CODE_PATHS = {
+    'pobb.in': 'https://pobb.in/:id:/raw',
+    'pastebin.com': 'https://pastebin.com/raw/:id:'
+}
+FETCH_TIMEOUT = (3.05, 10)
+FETCH_POOL_SIZE = 16
+FETCH_CACHE_SIZE = 1024
+FETCH_CACHE_TTL = 60 * 60
+URL_R = re.compile(r'(http(s)?:\/\/)?(www.)?(?P<url_base>\w+\.\w+)\/(?P<paste_id>\w+)')
+
+
+class BuildCodeFetcher:
+    def __init__(self, code_paths: dict = BUILD_CODE_PATHS, timeout: tuple = FETCH_TIMEOUT, pool_size: int = FETCH_POOL_SIZE,
+                 cache_size: int = FETCH_CACHE_SIZE, cache_ttl: Optional[float] = FETCH_CACHE_TTL):
+        self.code_paths = code_paths
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl, name='fetch')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def parse(self, url: str) -> Optional[tuple]:
+        if not (url and (url_match := URL_R.search(url))):
+            return None
+        if url_match.group('url_base') not in self.code_paths:
+            return None
+        return url_match.group('url_base'), url_match.group('paste_id')
+
+    def fetch(self, url: str) -> Optional[str]:
+        if not (key := self.parse(url)):
+            return None
+        if (pob_code := self.cache.get(key)) is not None:
+            return pob_code
+
+        # Concurrent requests for the same paste wait on the first one instead of fetching again
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+
+        pob_code = None
+        try:
+            pob_code = self._get(key)
+            if pob_code is not None:
+                self.cache.set(key, pob_code)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_result(pob_code)
+        return pob_code
+
+    def _get(self, key: tuple) -> Optional[str]:
+        host, paste_id = key
+        url = self.code_paths[host].replace(':id:', paste_id)
+        try:
+            resp = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as rqe:
+            logging.error("Failed to fetch build code from '%s': %s", url, rqe)
+            return None
+        if resp.status_code != 200:
+            logging.error("Failed to fetch build code from '%s', status %d", url, resp.status_code)
+            return None
+        return resp.text
+
+    async def fetch_async(self, url: str) -> Optional[str]:
+        return await asyncio.to_thread(self.fetch, url)
+
+    async def fetch_many(self, urls: list, concurrency: Optional[int] = None) -> list:
+        semaphore = asyncio.Semaphore(concurrency or self.pool_size)
+
+        async def fetch_one(url):
+            async with semaphore:
+                return await self.fetch_async(url)
+
+        return await asyncio.gather(*(fetch_one(url) for url in urls))
+
+    def close(self):
+        self.session.close()
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def default_fetcher() -> BuildCodeFetcher:
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = BuildCodeFetcher()
+        return _default_fetcher
+
+
+def fetch_pob_codes(urls: list, concurrency: Optional[int] = None) -> list:
+    return asyncio.run(default_fetcher().fetch_many(urls, concurrency))
@@ -0,0 +1,69 @@
+import os
+import json
+import numpy as np
+from typing import Optional
+
+from cache import LRUCache
+from pricestore import PriceStore
+
+GRAPH_MAX_POINTS = int(os.environ.get('LSA_GRAPH_MAX_POINTS', 500))
+FIGURE_CACHE_SIZE = 4096
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+
+figure_cache = LRUCache(maxsize=FIGURE_CACHE_SIZE, maxbytes=FIGURE_CACHE_BYTES, name='figure')
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    # Largest-Triangle-Three-Buckets: keeps the first and last points and the most significant point of each bucket
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        avg_start, avg_stop = int((bucket + 1) * every) + 1, min(int((bucket + 2) * every) + 1, n)
+        avg_x, avg_y = x[avg_start:avg_stop].mean(), y[avg_start:avg_stop].mean()
+        start, stop = int(bucket * every) + 1, int((bucket + 1) * every) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = indices[bucket + 1] = start + int(np.argmax(areas))
+    return indices
+
+
+def _trace(store: PriceStore, rows: np.ndarray, max_points: Optional[int]) -> dict:
+    days = np.asarray(store.columns['date'][rows], dtype=np.float64)
+    values = np.asarray(store.columns['value'][rows], dtype=np.float64)
+    if max_points:
+        keep = lttb(days, values, max_points)
+        rows, values = rows[keep], values[keep]
+    return {
+        'x': np.datetime_as_string(store.dates(rows)).tolist(),
+        'y': np.round(values, 2).tolist()
+    }
+
+
+def _cached_figure(key: tuple, build) -> dict:
+    if (figure_json := figure_cache.get(key)) is None:
+        figure_json = json.dumps(build(), separators=(',', ':'))
+        figure_cache.set(key, figure_json)
+    return json.loads(figure_json)
+
+
+def unique_figure(store: PriceStore, name: str, links: str, max_points: Optional[int] = GRAPH_MAX_POINTS) -> dict:
+    def build() -> dict:
+        # The (name, links, id) index keeps every id's rows contiguous and in date order
+        rows = store.select(name=name, links=links)
+        ids = np.asarray(store.columns['id'][rows])
+        bounds = np.r_[0, np.flatnonzero(ids[1:] != ids[:-1]) + 1, len(rows)]
+        return {'data': [_trace(store, rows[start:stop], max_points) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]}
+    # The store directory changes with every ingested generation, so stale figures are never served
+    return _cached_figure((store.store_dir, 'unique', name, links, max_points), build)
+
+
+def cluster_figure(store: PriceStore, name: str, variant: str, item_level: float, max_points: Optional[int] = GRAPH_MAX_POINTS) -> dict:
+    def build() -> dict:
+        rows = store.select(variant=variant, name=name, item_level=int(item_level))
+        rows = rows[np.argsort(store.columns['date'][rows], kind='stable')]
+        return {'data': [_trace(store, rows, max_points)]}
+    return _cached_figure((store.store_dir, 'cluster', name, variant, item_level, max_points), build)
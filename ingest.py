@@ -0,0 +1,73 @@
+import os
+import logging
+import requests
+from typing import Optional
+from zipfile import ZipFile, BadZipFile
+
+from pobutils import iter_data, DATA_CHUNK_SIZE
+from clusterids import CLUSTER_IDS_URL, refresh_cluster_levels
+from pricestore import PriceStore, append_price_store, store_lock, cluster_ids_path, store_path, dump_path
+
+DUMP_URL = 'https://poe.ninja/api/data/getdump?name={league}'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (3.05, 60)
+
+
+def download_dump(url: str, dest: str) -> bool:
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    part_file = f'{dest}.part'
+    try:
+        with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+            if resp.status_code != 200:
+                logging.error("Failed to fetch dump from '%s', status %d", url, resp.status_code)
+                return False
+            with open(part_file, 'wb') as dump_file:
+                for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    dump_file.write(chunk)
+    except requests.RequestException as rqe:
+        logging.error("Failed to fetch dump from '%s': %s", url, rqe)
+        return False
+    os.replace(part_file, dest)
+    return True
+
+
+def open_store(store_dir: str) -> Optional[PriceStore]:
+    if not os.path.isdir(store_dir):
+        return None
+    try:
+        return PriceStore(os.path.realpath(store_dir))
+    except ValueError as ve:
+        logging.warning("%s, rebuilding from the full dump...", ve)
+        return None
+
+
+def ingest_dump(zip_file: str, cluster_ids_file: str, store_dir: str, chunksize: int = DATA_CHUNK_SIZE) -> int:
+    try:
+        # The base is opened under the lock, so a concurrent ingest's rows are not appended twice
+        with store_lock(store_dir), ZipFile(zip_file) as dump:
+            base = open_store(store_dir)
+            members = [name for name in dump.namelist() if name.endswith('.items.csv')]
+            if not members:
+                logging.error("No items CSV found in '%s'", zip_file)
+                return 0
+            with dump.open(members[0]) as items_file:
+                new_rows = append_price_store(iter_data(items_file, chunksize), cluster_ids_file, store_dir, base)
+    except (OSError, BadZipFile) as e:
+        logging.error("Could not read dump '%s': %s", zip_file, e)
+        return 0
+    logging.info("Ingested %d new rows from '%s'", new_rows, zip_file)
+    return new_rows
+
+
+def ingest_league(root_dir: str, league: str, dump_url: Optional[str] = None, cluster_ids_url: Optional[str] = None) -> int:
+    zip_file = dump_path(root_dir, league)
+    if not download_dump(dump_url or DUMP_URL.format(league=league), zip_file):
+        return 0
+    cluster_ids_file = cluster_ids_path(root_dir, league)
+    refresh_cluster_levels(cluster_ids_url or CLUSTER_IDS_URL.format(league=league), cluster_ids_file)
+    new_rows = ingest_dump(zip_file, cluster_ids_file, store_path(root_dir, league))
+    if new_rows:
+        # Imported here since the cube is only rebuilt after new rows were added
+        from analytics import load_cube
+        load_cube(root_dir, league)
+    return new_rows
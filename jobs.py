@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+import tempfile
+import functools
+import diskcache
+import psutil
+from dash import DiskcacheManager
+
+from metrics import metrics, merge_snapshots
+
+JOB_CACHE_DIR = os.environ.get('LSA_JOB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'lsa-jobs'))
+JOB_QUEUE_LIMIT = int(os.environ.get('LSA_JOB_QUEUE_LIMIT', 32))
+JOB_TIMEOUT = 5 * 60
+JOB_RESULT_TTL = 60 * 60
+AUDIT_STAGES = ('fetch', 'decode', 'price', 'render')
+WORKER_METRICS_INTERVAL = 1.0
+EMPTY_SNAPSHOT = {'counters': {}, 'histograms': {}}
+
+job_cache = diskcache.Cache(JOB_CACHE_DIR)
+background_manager = DiskcacheManager(job_cache, expire=JOB_RESULT_TTL)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _alive(pid: int) -> bool:
+    # A terminated job lingers as a zombie until its parent reaps it, which under gunicorn is often another worker
+    # that never does, and psutil.pid_exists still reports zombies
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class JobSlots:
+    # Jobs run in separate processes, so running jobs are tracked by pid in the shared cache
+    def __init__(self, cache: diskcache.Cache, limit: int = JOB_QUEUE_LIMIT, key: str = 'audit-jobs'):
+        self.cache = cache
+        self.limit = limit
+        self.key = key
+
+    def _running(self) -> set:
+        # Jobs that Dash terminated never release their slot, so drop any whose process is gone
+        return {pid for pid in self.cache.get(self.key, set()) if _alive(pid)}
+
+    def __enter__(self):
+        with diskcache.Lock(self.cache, f'{self.key}-lock', expire=JOB_TIMEOUT):
+            running = self._running()
+            if len(running) >= self.limit:
+                raise QueueFull(f"{len(running)} audits already running")
+            self.cache.set(self.key, running | {os.getpid()})
+        return self
+
+    def __exit__(self, *exc_info):
+        with diskcache.Lock(self.cache, f'{self.key}-lock', expire=JOB_TIMEOUT):
+            self.cache.set(self.key, self._running() - {os.getpid()})
+
+    def running(self) -> int:
+        return len(self._running())
+
+
+job_slots = JobSlots(job_cache)
+
+
+class JobLock:
+    # Held by pid, so a lock whose job Dash terminated is taken over instead of waiting for it to expire
+    def __init__(self, cache: diskcache.Cache, key, expire: float = JOB_TIMEOUT, poll: float = 0.01):
+        self.cache = cache
+        self.key = key
+        self.expire = expire
+        self.poll = poll
+
+    def __enter__(self):
+        pid = os.getpid()
+        while not self.cache.add(self.key, pid, expire=self.expire):
+            with self.cache.transact():
+                holder = self.cache.get(self.key)
+                if holder is not None and not _alive(holder):
+                    logging.warning("Reclaiming job lock %s from exited process %d", self.key, holder)
+                    self.cache.set(self.key, pid, expire=self.expire)
+                    break
+            time.sleep(self.poll)
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.cache.transact():
+            if self.cache.get(self.key) == os.getpid():
+                self.cache.delete(self.key)
+
+
+def run_deduplicated(key: tuple, compute):
+    # Identical audits submitted at the same time wait for the first one and share its result
+    if (result := job_cache.get(('result',) + key)) is not None:
+        return result
+    with JobLock(job_cache, ('lock',) + key):
+        if (result := job_cache.get(('result',) + key)) is not None:
+            return result
+        if (result := compute()) is not None:
+            job_cache.set(('result',) + key, result, expire=JOB_RESULT_TTL)
+    return result
+
+
+def shared_cached(cache_name: str, key, compute, expire: float = JOB_RESULT_TTL):
+    # Every background job is a new process, so in-process caches only outlive a job when backed by the job cache
+    if (value := job_cache.get((cache_name, key))) is not None:
+        metrics.inc('lsa_cache_requests_total', cache=f'job_{cache_name}', result='hit')
+        return value
+    metrics.inc('lsa_cache_requests_total', cache=f'job_{cache_name}', result='miss')
+    if (value := compute()) is not None:
+        job_cache.set((cache_name, key), value, expire=expire)
+    return value
+
+
+def publishes_metrics(fn):
+    # Job processes are forked from the server, so drop the copied values and publish only this job's
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        metrics.reset()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            snapshot = metrics.snapshot(reset=True)
+            with diskcache.Lock(job_cache, 'metrics-lock', expire=JOB_TIMEOUT):
+                job_cache.set('metrics', merge_snapshots(job_cache.get('metrics', EMPTY_SNAPSHOT), snapshot))
+    return wrapper
+
+
+def job_metrics() -> list:
+    return [snapshot] if (snapshot := job_cache.get('metrics')) else []
+
+
+def _process_key(pid: int) -> str:
+    # The start time tells a restarted worker apart from an exited one that had the same pid
+    return f'{pid}-{psutil.Process(pid).create_time()}'
+
+
+def _process_alive(key: str) -> bool:
+    pid = int(key.split('-', 1)[0])
+    try:
+        return _process_key(pid) == key and _alive(pid)
+    except psutil.NoSuchProcess:
+        return False
+
+
+def publish_worker_metrics():
+    # Server workers keep cumulative totals here, exited workers are folded into 'retired' so no count is ever lost
+    with JobLock(job_cache, 'worker-metrics-lock'):
+        workers = job_cache.get('worker-metrics', {})
+        exited = [key for key in workers if key != 'retired' and not _process_alive(key)]
+        if exited:
+            workers['retired'] = merge_snapshots(workers.get('retired', EMPTY_SNAPSHOT), *(workers.pop(key) for key in exited))
+        workers[_process_key(os.getpid())] = metrics.snapshot()
+        job_cache.set('worker-metrics', workers)
+
+
+def worker_metrics() -> list:
+    # Published before reading, so a total one worker has reported is never reported lower by another
+    publish_worker_metrics()
+    own = _process_key(os.getpid())
+    return [snapshot for key, snapshot in job_cache.get('worker-metrics', {}).items() if key != own]
+
+
+def register_worker_metrics(server):
+    published = {'at': time.monotonic()}
+
+    @server.after_request
+    def publish_periodically(response):
+        if time.monotonic() - published['at'] >= WORKER_METRICS_INTERVAL:
+            published['at'] = time.monotonic()
+            publish_worker_metrics()
+        return response
+
+
+def stage_message(stage: str) -> str:
+    step = AUDIT_STAGES.index(stage) + 1
+    logging.debug("Audit stage %s (%d/%d)", stage, step, len(AUDIT_STAGES))
+    return f"{stage.capitalize()} ({step}/{len(AUDIT_STAGES)})..."
@@ -0,0 +1,79 @@
+import os
+import logging
+import threading
+from typing import Optional
+from collections import OrderedDict
+
+from pricing import PricingEngine
+from pricestore import PriceStore, PriceStoreHandle, has_price_data, store_path, STORE_CHECK_INTERVAL
+
+LEAGUE_MEMORY_BUDGET = int(os.environ.get('LSA_LEAGUE_MEMORY_MB', 4096)) * 1024 * 1024
+
+
+class LeagueRegistry:
+    def __init__(self, root_dir: str, memory_budget: int = LEAGUE_MEMORY_BUDGET, check_interval: float = STORE_CHECK_INTERVAL):
+        self.root_dir = root_dir
+        self.memory_budget = memory_budget
+        self.check_interval = check_interval
+        self._handles = OrderedDict()
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def leagues(self) -> list:
+        data_dir = os.path.join(self.root_dir, 'data')
+        if not os.path.isdir(data_dir):
+            return []
+        return sorted(league for league in os.listdir(data_dir) if has_price_data(self.root_dir, league))
+
+    def handle(self, league: str) -> Optional[PriceStoreHandle]:
+        with self._lock:
+            if league in self._handles:
+                self._handles.move_to_end(league)
+                self._evict()
+                return self._handles[league]
+        if league not in self.leagues():
+            return None
+
+        # Load outside the lock so a slow first load does not block other leagues
+        handle = PriceStoreHandle(self.root_dir, league, self.check_interval)
+        if not handle.store:
+            logging.error("Could not load price data for %s", league)
+            return None
+        with self._lock:
+            handle = self._handles.setdefault(league, handle)
+            self._handles.move_to_end(league)
+            self._evict()
+        return handle
+
+    def _evict(self):
+        # The most recently used league always stays resident, even if it alone exceeds the budget
+        while len(self._handles) > 1 and self.nbytes > self.memory_budget:
+            league, _ = self._handles.popitem(last=False)
+            self._engines.pop(league, None)
+            logging.info("Evicted price data for %s", league)
+
+    def generation(self, league: str) -> Optional[str]:
+        # Read from the store symlink, so callers can key on a league's data version without loading it
+        path = store_path(self.root_dir, league)
+        return os.path.basename(os.path.realpath(path)) if os.path.isdir(path) else None
+
+    def store(self, league: str) -> Optional[PriceStore]:
+        handle = self.handle(league)
+        return handle.get() if handle else None
+
+    def engine(self, league: str) -> Optional[PricingEngine]:
+        if not (store := self.store(league)):
+            return None
+        with self._lock:
+            engine = self._engines.get(league)
+            if engine is None or engine.store is not store:
+                engine = self._engines[league] = PricingEngine(store)
+        return engine
+
+    @property
+    def nbytes(self) -> int:
+        return sum(handle.store.nbytes for handle in self._handles.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'resident': list(self._handles), 'bytes': self.nbytes, 'budget': self.memory_budget}
@@ -0,0 +1,76 @@
+import time
+import logging
+import threading
+import psutil
+
+from metrics import metrics
+
+# Forked workers inherit this, so startup times are measured from the server's own start
+PROCESS_STARTED = psutil.Process().create_time()
+
+
+def since_start() -> float:
+    return time.time() - PROCESS_STARTED
+
+
+class WarmUp:
+    # Loads each league's store and pricing engine ahead of the first request, readiness waits for the first league
+    def __init__(self, registry, leagues: list):
+        self.registry = registry
+        self.leagues = list(leagues)
+        self.status = {league: 'pending' for league in self.leagues}
+        self.seconds = None
+        self._thread = None
+
+    def run(self):
+        start = time.perf_counter()
+        for league in self.leagues:
+            self.status[league] = 'loading'
+            try:
+                self.status[league] = 'ready' if self.registry.engine(league) else 'missing'
+            except Exception:
+                logging.exception("Could not load price data for %s", league)
+                self.status[league] = 'failed'
+        self.seconds = time.perf_counter() - start
+        metrics.observe('lsa_startup_seconds', self.seconds, phase='warm_up')
+        logging.info("Warmed up %s in %0.2fs: %s", ', '.join(self.leagues), self.seconds, self.status)
+
+    def start(self, background: bool = True) -> 'WarmUp':
+        if background:
+            self._thread = threading.Thread(target=self.run, name='warm-up', daemon=True)
+            self._thread.start()
+        else:
+            self.run()
+        return self
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.leagues) and self.status[self.leagues[0]] == 'ready'
+
+
+def register_lifecycle(server, warm_up: WarmUp):
+    from flask import jsonify, request
+
+    first_request = {}
+
+    @server.before_request
+    def time_first_request():
+        if not first_request and request.path not in ('/healthz', '/readyz'):
+            first_request['seconds'] = since_start()
+            metrics.observe('lsa_startup_seconds', first_request['seconds'], phase='first_request')
+            logging.info("First request %.2fs after process start", first_request['seconds'])
+
+    @server.route('/healthz')
+    def healthz():
+        return jsonify(status='ok', uptime_seconds=round(since_start(), 3))
+
+    @server.route('/readyz')
+    def readyz():
+        body = {
+            'ready': warm_up.ready,
+            'leagues': warm_up.status,
+            'warm_up_seconds': warm_up.seconds and round(warm_up.seconds, 3),
+            'first_request_seconds': first_request.get('seconds') and round(first_request['seconds'], 3),
+            'uptime_seconds': round(since_start(), 3)
+        }
+        return jsonify(body), 200 if warm_up.ready else 503
@@ -1,14 +1,42 @@
-import logging
+import gc
 import os
+import logging
+import argparse
 from dash import Dash, html, page_registry, page_container
 
+from lifecycle import WarmUp, register_lifecycle, since_start
+from metrics import metrics, register_routes
+from settings import LEAGUE
+
 logging.basicConfig(level=logging.INFO)
-LEAGUE = 'Affliction'
-ROOT_DIR = os.path.dirname(__file__)
+HOST = os.environ.get('LSA_HOST', '0.0.0.0')
+PORT = int(os.environ.get('LSA_PORT', 4444))
+WORKERS = int(os.environ.get('LSA_WORKERS', min(2 * (os.cpu_count() or 1) + 1, 8)))
+THREADS = int(os.environ.get('LSA_THREADS', 4))
+WORKER_TIMEOUT = 120
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+COMPRESS_MIN_SIZE = 500
+# 'background' serves requests while the default league loads, 'blocking' loads it before returning the app
+WARM_UP = os.environ.get('LSA_WARM_UP', 'background')
 
-if __name__ == '__main__':
-    app = Dash(__name__, use_pages=True)
+
+def create_app(warm_up: str = WARM_UP) -> Dash:
+    metrics.observe('lsa_startup_seconds', since_start(), phase='import')
+    # Dash appends each asset's modification time to its URL, so static files can be cached for a long time
+    app = Dash(__name__, use_pages=True, compress=True)
     app.config.suppress_callback_exceptions = True
+    app.server.config.update(SEND_FILE_MAX_AGE_DEFAULT=STATIC_MAX_AGE, COMPRESS_MIN_SIZE=COMPRESS_MIN_SIZE)
+
+    # Imported here since jobs sets up the background callback cache. Every server process publishes
+    # its metrics there, so any worker answering a scrape reports the totals of all of them.
+    from jobs import job_metrics, worker_metrics, register_worker_metrics
+    register_routes(app.server, lambda: job_metrics() + worker_metrics())
+    register_worker_metrics(app.server)
+    # The API shares the page's league registry, so every league's store is only loaded once
+    from api import register_api
+    from pages.auditor import registry
+    register_api(app.server, registry, LEAGUE)
+    register_lifecycle(app.server, WarmUp(registry, [LEAGUE]).start(background=warm_up == 'background'))
 
     app.layout = html.Div([
         html.Nav([
@@ -23,5 +51,52 @@ if __name__ == '__main__':
         ], className='navbar navbar-expand-lg mx-3'),
         page_container
     ])
+    metrics.observe('lsa_startup_seconds', since_start(), phase='app_created')
+    logging.info("App created %.2fs after process start", since_start())
+    return app
+
+
+def serve(host: str = HOST, port: int = PORT, workers: int = WORKERS, threads: int = THREADS):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread' if threads > 1 else 'sync')
+            self.cfg.set('timeout', WORKER_TIMEOUT)
+            self.cfg.set('preload_app', True)
+            self.cfg.set('post_fork', self.post_fork)
+
+        @staticmethod
+        def post_fork(server, worker):
+            # The master published its startup metrics before forking, each worker counts only its own from here
+            metrics.reset()
+
+        def load(self):
+            # Preloaded in the master, so workers share the loaded price store copy-on-write.
+            # Freezing moves everything loaded so far out of the collector, which would otherwise
+            # touch (and so copy) those pages in every worker.
+            server = create_app(warm_up='blocking').server
+            from jobs import publish_worker_metrics
+            publish_worker_metrics()
+            gc.freeze()
+            return server
+
+    Server().run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the LeagueStartAuditor web app")
+    parser.add_argument('--debug', action='store_true', help="run the Flask development server with the reloader")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS, help="worker processes (LSA_WORKERS)")
+    parser.add_argument('-t', '--threads', type=int, default=THREADS, help="threads per worker (LSA_THREADS)")
+    args = parser.parse_args()
 
-    app.run(debug=True, host='0.0.0.0', port='4444')
+    if args.debug:
+        create_app().run(debug=True, host=args.host, port=args.port)
+    else:
+        serve(args.host, args.port, args.workers, args.threads)
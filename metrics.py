@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import logging
+import threading
+import functools
+from collections import Counter, defaultdict
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+PROFILE_SLOW_MS = float(os.environ['LSA_PROFILE_SLOW_MS']) if os.environ.get('LSA_PROFILE_SLOW_MS') else None
+PROFILE_DIR = os.environ.get('LSA_PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = 0.005
+
+
+def merge_snapshots(*snapshots) -> dict:
+    counters = defaultdict(float)
+    histograms = {}
+    for snapshot in snapshots:
+        for key, value in snapshot['counters'].items():
+            counters[key] += value
+        for key, histogram in snapshot['histograms'].items():
+            merged = histograms.setdefault(key, {'buckets': histogram['buckets'], 'counts': [0] * len(histogram['counts']), 'sum': 0.0})
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+    return {'counters': dict(counters), 'histograms': histograms}
+
+
+def _labels(labels: tuple, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Metrics:
+    # Every value is additive, so snapshots from job processes can simply be summed into the server's
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0})
+            histogram['counts'][next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            histogram['sum'] += value
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self._lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'histograms': {key: dict(histogram, counts=list(histogram['counts'])) for key, histogram in self.histograms.items()}
+            }
+            if reset:
+                self.counters = defaultdict(float)
+                self.histograms = {}
+        return snapshot
+
+    def render(self, extra_snapshots: list = ()) -> str:
+        merged = merge_snapshots(self.snapshot(), *extra_snapshots)
+
+        lines = []
+        for name in sorted({name for name, _ in merged['counters']}):
+            lines.append(f'# TYPE {name} counter')
+            lines += [f'{name}{_labels(labels)} {value:g}' for (key, labels), value in sorted(merged['counters'].items()) if key == name]
+        for name in sorted({name for name, _ in merged['histograms']}):
+            lines.append(f'# TYPE {name} histogram')
+            for (key, labels), histogram in sorted(merged['histograms'].items()):
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(histogram['buckets']) + ['+Inf'], histogram['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]:g}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path: str):
+        # Folded stacks, as consumed by flamegraph.pl and speedscope
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as folded_file:
+            folded_file.writelines(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def timed(name: str, profile: bool = False, **labels):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = SamplingProfiler(threading.get_ident()) if profile and PROFILE_SLOW_MS is not None else None
+            start = time.perf_counter()
+            try:
+                if profiler:
+                    with profiler:
+                        return fn(*args, **kwargs)
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.observe(name, elapsed, **labels)
+                if profiler and elapsed * 1000 >= PROFILE_SLOW_MS:
+                    path = os.path.join(PROFILE_DIR, '{}-{}-{}.folded'.format(fn.__name__, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+                    profiler.write_folded(path)
+                    logging.warning("%s took %0.0fms, wrote profile to '%s'", fn.__name__, elapsed * 1000, path)
+        return wrapper
+    return decorator
+
+
+def register_routes(server, extra_snapshots=lambda: []):
+    from flask import Response, request
+
+    @server.route('/metrics')
+    def metrics_route():
+        return Response(metrics.render(extra_snapshots()), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def record_payload(response):
+        if request.path == '/_dash-update-component' and not response.direct_passthrough:
+            output = (request.get_json(silent=True) or {}).get('output', 'unknown')
+            metrics.observe('lsa_callback_request_bytes', request.content_length or 0, SIZE_BUCKETS, output=output)
+            metrics.observe('lsa_callback_response_bytes', response.calculate_content_length() or 0, SIZE_BUCKETS, output=output)
+        return response
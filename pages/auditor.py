@@ -1,26 +1,88 @@
-import os
 import logging
 import validators
+from typing import Optional
 import numpy as np
 import pandas as pd
 import dash_bootstrap_components as dbc
-from dash import html, dcc, register_page, callback, Output, Input
-from pobutils import get_pob_code_from_url, read_pob_to_xml, get_uniques_from_xml, get_clusters_from_xml, get_stats_from_xml, load_data
-
-from main import LEAGUE, ROOT_DIR
+from dash import html, dcc, register_page, callback, clientside_callback, no_update, Output, Input, State
+from pobutils import get_pob_code_from_url
+from buildcache import get_build, build_hash
+from leagues import LeagueRegistry
+from graphs import unique_figure, cluster_figure
+from jobs import background_manager, job_slots, run_deduplicated, shared_cached, publishes_metrics, stage_message, QueueFull
+from metrics import timed
+from pricestore import PriceStore
+from pricing import AuditResult, PricedItem, WINDOW_DAYS
+
+from settings import LEAGUE, ROOT_DIR
 
 register_page(__name__, path='/')
 
-if not os.path.isfile(os.path.join(ROOT_DIR, f'data/{LEAGUE}/{LEAGUE}.items.csv')):
-    logging.error("Data file not found, exiting...")
-    exit(1)
+# Stores load lazily, the app factory warms up the default league (see lifecycle.WarmUp)
+registry = LeagueRegistry(ROOT_DIR)
+
+
+def selected_leagues(leagues) -> list:
+    if not leagues:
+        return [LEAGUE]
+    return [leagues] if isinstance(leagues, str) else list(leagues)
 
-data = load_data(os.path.join(ROOT_DIR, f'data/{LEAGUE}/{LEAGUE}.items.csv'))
-try:
-    cluster_item_levels = pd.read_csv(os.path.join(ROOT_DIR, f'data/{LEAGUE}/{LEAGUE}.clusterjewels.ids.csv'))
-    data = data.merge(cluster_item_levels, on='Id', how='left')
-except FileNotFoundError as fnfe:
-    logging.error("Could not read from item level CSV file")
+
+def price_header_row() -> html.Tr:
+    return html.Tr([html.Th(['Item']), html.Th(['First price']), html.Th(['First seen']), html.Th(['Week 1 Price']), html.Th(['Days {}-{}, all links (median / p90)'.format(*WINDOW_DAYS)])])
+
+
+def price_row(item: PricedItem) -> html.Tr:
+    if not item.priced:
+        return html.Tr([html.Td([item.name]), html.Td(['No data']), html.Td([]), html.Td([]), html.Td([])])
+    if item.week1_price is None:
+        week1_price_cell = html.Td(['No data'])
+    else:
+        week1_price_cell = html.Td([round(item.week1_price), ' chaos (', '{:+0.0f}'.format(item.week1_change or 0), '%)'])
+    if item.window_median is None:
+        window_cell = html.Td(['No data'])
+    else:
+        window_cell = html.Td(['{:0,.0f} / {:0,.0f} chaos'.format(item.window_median, item.window_p90)])
+    return html.Tr([html.Td([item.name]), html.Td([item.first_price, ' chaos']), html.Td([item.first_seen.strftime('%x')]), week1_price_cell, window_cell])
+
+
+def total_cost(total_chaos: int, window_median: float = 0.0, window_p90: float = 0.0) -> list:
+    if total_chaos <= 0:
+        return []
+    cost = [
+        html.H4(['Total cost:']),
+        html.H4(['{:0,.0f} chaos'.format(total_chaos)])
+    ]
+    if window_median > 0:
+        cost.append(html.P(['Days {}-{}: '.format(*WINDOW_DAYS), '{:0,.0f} chaos median, {:0,.0f} chaos p90'.format(window_median, window_p90)]))
+    return cost
+
+
+def league_comparison(results: dict) -> list:
+    if len(results) < 2:
+        return []
+    rows = [html.Tr([html.Th(['League']), html.Th(['Uniques']), html.Th(['Clusters']), html.Th(['Week 1 Total'])])]
+    for league, result in results.items():
+        if result is None:
+            rows.append(html.Tr([html.Td([league]), html.Td(['No data']), html.Td([]), html.Td([])]))
+            continue
+        rows.append(html.Tr([html.Td([league])] + [html.Td(['{:0,.0f} chaos'.format(total)]) for total in (result.unique_total, result.cluster_total, result.week1_total)]))
+    return [html.H4(['League Comparison']), html.Table(rows, className='col-9')]
+
+
+def dependent_options(store: PriceStore, result: AuditResult) -> dict:
+    # Sent along with the audit so the link, variant and item level dropdowns are filled in client-side
+    options = {'links': {}, 'variants': {}, 'item_levels': {}}
+    if not store:
+        return options
+    for name in result.unique_options:
+        options['links'][name] = pd.unique(store.decode('links', store.select(name=name))).tolist()
+    for name in result.cluster_options:
+        rows = store.select(name=name)
+        options['variants'][name] = pd.unique(store.decode('variant', rows)).tolist()
+        item_levels = np.asarray(store.columns['item_level'][rows])
+        options['item_levels'][name] = pd.unique(item_levels[item_levels >= 0]).astype(float).tolist()
+    return options
 
 
 def layout():
@@ -29,6 +91,11 @@ def layout():
     html.Div([
         dcc.Input(id='pob_input', placeholder="Pastebin/pobb.in Link", type='text', className='form-control'),
     ], className='input-group input-group-lg'),
+    dcc.Dropdown(id='league_dropdown', options=registry.leagues(), value=[LEAGUE], multi=True, placeholder="League", className='mt-2'),
+    html.P(id='audit_progress', className='mt-2 text-muted', style={'display': 'none'}),
+    html.H5(id='audit_status', className='mt-2', style={'color': 'orange'}),
+    dcc.Store(id='audit_options'),
+    dcc.Store(id='league_status'),
     dcc.Loading([
         html.Div([
             html.H4("Could not load build, please ensure the given link or build code is valid", id='error_reading_pob', style={'color': 'red', 'display': 'none'}, className='mt-4')
@@ -41,6 +108,7 @@ def layout():
                 html.Div(id='dps_stats', className='col-4')
             ], className='row align-items-start p-3', style={'margin': 'auto'})
         ]),
+        html.Div(id='league_comparison', className='p-3'),
         html.Div([
             html.H4(['Uniques']),
             html.Div([
@@ -78,6 +146,15 @@ def layout():
 ], className='m-5 px-5')
 
 
+@callback(
+    Output('league_status', 'data'),
+    Input('league_dropdown', 'value')
+)
+def load_selected_leagues(leagues: list) -> dict:
+    # Runs in the server process, so audit jobs forked from it afterwards inherit the loaded stores
+    return {league: registry.engine(league) is not None for league in selected_leagues(leagues)}
+
+
 @callback([
     Output('unique_dropdown', 'options'),
     Output('unique_dropdown', 'value'),
@@ -91,80 +168,68 @@ def layout():
     Output('offensive_misc_stats_table', 'children'),
     Output('defensive_stats_table', 'children'),
     Output('dps_stats', 'children'),
-    Input('pob_input', 'value')
-])
-def update_page_with_new_build(pob_input: str):
+    Output('league_comparison', 'children'),
+    Output('audit_options', 'data'),
+    Output('audit_status', 'children'),
+    Input('pob_input', 'value'),
+    Input('league_dropdown', 'value')
+], background=True, manager=background_manager, progress=[Output('audit_progress', 'children')],
+   running=[(Output('audit_progress', 'style'), {'display': 'block'}, {'display': 'none'})])
+@publishes_metrics
+@timed('lsa_callback_seconds', profile=True, callback='update_page_with_new_build')
+def update_page_with_new_build(set_progress, pob_input: str, leagues: list):
+    # Dash runs this as a background job and terminates it if the input changes before it finishes
+    try:
+        with job_slots:
+            return audit_page(set_progress, pob_input, leagues) + [[]]
+    except QueueFull as qf:
+        logging.warning("Rejecting audit, %s", qf)
+        return [no_update] * 14 + [["The server is busy, please try again in a moment"]]
+
+
+def audit_build_input(set_progress, pob_input: str, leagues: list) -> Optional[dict]:
+    set_progress((stage_message('fetch'),))
     if validators.url(pob_input):
-        pob_code = get_pob_code_from_url(pob_input)
-        pob_xml = read_pob_to_xml(pob_code)
+        pob_code = shared_cached('fetch', pob_input, lambda: get_pob_code_from_url(pob_input))
     else:
-        pob_xml = read_pob_to_xml(pob_input)
-
-    if not pob_xml:
-        return [], None, [], None, [], [], [], [], [], [], [], []
-
-    build_uniques = get_uniques_from_xml(pob_xml)
-    build_clusters = get_clusters_from_xml(pob_xml)
-
-    unique_total_cost_chaos = 0
-    unique_dropdown_options = set()
-    unique_price_breakdown = [html.Tr([html.Th(['Item']), html.Th(['First price']), html.Th(['First seen']), html.Th(['Week 1 Price'])])]
-    for item in build_uniques:
-        item_history = data.loc[(data['Name'] == item.name)]
-        dates = data.loc[(data['Name'] == item.name), 'Date']
-        if dates.size > 0:
-            first_date = dates.iloc[0]
-            first_price = round(item_history['Value'].iloc[0])
-            week1_price = round(item_history.loc[item_history['Date'] == first_date + np.timedelta64(7, 'D'), 'Value'].iloc[0])
-            week1_pct_change = (week1_price - first_price) / first_price * 100
-            unique_price_breakdown.append(html.Tr([html.Td([item.name]), html.Td([first_price, ' chaos']), html.Td([first_date.strftime('%x')]), html.Td([week1_price, ' chaos (', '{:+0.0f}'.format(week1_pct_change), '%)'])]))
-            unique_total_cost_chaos += first_price
-            unique_dropdown_options.add(item.name)
-        else:
-            unique_price_breakdown.append(html.Tr([html.Td([item.name]), html.Td(['No data']), html.Td([]), html.Td([])]))
-
-    unique_dropdown_options = list(unique_dropdown_options) if unique_dropdown_options else None
-    unique_dropdown_default = unique_dropdown_options[0] if build_uniques else None
-    if unique_total_cost_chaos > 0:
-        unique_total_cost = [
-            html.H4(['Total cost:']),
-            html.H4(['{:0,.0f} chaos'.format(unique_total_cost_chaos)])
-        ]
-    else:
-        unique_total_cost = []
-
-    cluster_price_breakdown = [html.Tr([html.Th(['Item']), html.Th(['First price']), html.Th(['First seen']), html.Th(['Week 1 Price'])])]
-    cluster_dropdown_options = set()
-    cluster_total_cost_chaos = 0
-    for item in build_clusters:
-        item_history = data.loc[(data['BaseType'] == item.size) & (data['Variant'] == "{} passives".format(item.num_passives)) & (data['Name'] == item.small_passives)]
-        cluster_levels = item_history['ItemLevel'].unique()
-        min_ilvl = cluster_levels[cluster_levels < item.level].max()
-        item_history = item_history.loc[item_history['ItemLevel'] == min_ilvl]
-
-        item_name = '{}, {}, {} passives, Level {:0.0f}'.format(item.small_passives, item.size, item.num_passives, min_ilvl)
-        cluster_dropdown_options.add(item.small_passives)
-        if item_history.size > 0:
-            first_date = item_history['Date'].iloc[0]
-            first_price = round(item_history['Value'].iloc[0])
-            week1_price = round(item_history.loc[item_history['Date'] == first_date + np.timedelta64(7, 'D'), 'Value'].iloc[0])
-            week1_pct_change = (week1_price - first_price) / first_price * 100
-            cluster_price_breakdown.append(html.Tr([html.Td([item_name]), html.Td([first_price, ' chaos']), html.Td([first_date.strftime('%x')]), html.Td([week1_price, ' chaos (', '{:+0.0f}'.format(week1_pct_change), '%)'])]))
-            cluster_total_cost_chaos += first_price
-        else:
-            cluster_price_breakdown.append(html.Tr([html.Td([item_name]), html.Td(['No data']), html.Td([]), html.Td([])]))
-
-    cluster_dropdown_options = list(cluster_dropdown_options)
+        pob_code = pob_input
+
+    set_progress((stage_message('decode'),))
+    build = shared_cached('build', build_hash(pob_code), lambda: get_build(pob_code)) if pob_code else None
+    if not build:
+        return None
+
+    # The first selected league drives the detailed breakdown, the others are compared by totals
+    set_progress((stage_message('price'),))
+    results = {league: engine.audit_build(build) if (engine := registry.engine(league)) else None for league in leagues}
+    result = results[leagues[0]] or AuditResult(character=build.character, display_stats=build.display_stats)
+    return {'result': result, 'results': results, 'options': dependent_options(registry.store(leagues[0]), result)}
+
+
+def audit_page(set_progress, pob_input: str, leagues: list) -> list:
+    # Keyed on the raw input and each league's data generation, so a repeated audit skips fetching, decoding and store loads
+    if not (pob_input := (pob_input or '').strip()):
+        return [[], None, [], None, [], [], [], [], [], [], [], [], [], None]
+    leagues = selected_leagues(leagues)
+    audit = run_deduplicated((build_hash(pob_input),) + tuple((league, registry.generation(league)) for league in leagues),
+                             lambda: audit_build_input(set_progress, pob_input, leagues))
+    if not audit:
+        return [[], None, [], None, [], [], [], [], [], [], [], [], [], None]
+    result, results = audit['result'], audit['results']
+
+    set_progress((stage_message('render'),))
+
+    unique_price_breakdown = [price_header_row()] + [price_row(item) for item in result.uniques]
+    unique_dropdown_options = result.unique_options or None
+    unique_dropdown_default = unique_dropdown_options[0] if unique_dropdown_options else None
+    unique_total_cost = total_cost(result.unique_total, result.unique_window_median, result.unique_window_p90)
+
+    cluster_price_breakdown = [price_header_row()] + [price_row(item) for item in result.clusters]
+    cluster_dropdown_options = result.cluster_options
     cluster_dropdown_options_default = cluster_dropdown_options[0] if cluster_dropdown_options else None
-    if cluster_total_cost_chaos > 0:
-        cluster_total_cost = [
-            html.H4(['Total cost:']),
-            html.H4(['{:0,.0f} chaos'.format(cluster_total_cost_chaos)])
-        ]
-    else:
-        cluster_total_cost = []
+    cluster_total_cost = total_cost(result.cluster_total, result.cluster_window_median, result.cluster_window_p90)
 
-    character, display_stats = get_stats_from_xml(pob_xml)
+    character, display_stats = result.character, result.display_stats
     character_level_ascendancy = [f"Level {character.get('level')} {character.get('class')}"]
     offensive_misc_stats_table = []
     defensive_stats_table = []
@@ -197,95 +262,87 @@ def update_page_with_new_build(pob_input: str):
 
     dps_stats = [html.P([ability[0], ': {:0,.0f}'.format(ability[1])], className='mb-2') for ability in character.get('FullDPSSkill', [])]
 
-    return unique_dropdown_options, unique_dropdown_default, cluster_dropdown_options, cluster_dropdown_options_default, unique_price_breakdown, cluster_price_breakdown, unique_total_cost, cluster_total_cost, character_level_ascendancy, offensive_misc_stats_table, defensive_stats_table, dps_stats
+    return [unique_dropdown_options, unique_dropdown_default, cluster_dropdown_options, cluster_dropdown_options_default, unique_price_breakdown, cluster_price_breakdown, unique_total_cost, cluster_total_cost, character_level_ascendancy, offensive_misc_stats_table, defensive_stats_table, dps_stats, league_comparison(results), audit['options']]
 
 
-@callback(
+DEPENDENT_OPTIONS_JS = """
+function(selected, options) {
+    const values = (options && options['%s'][selected]) || [];
+    return [values, values.length ? values[0] : null];
+}
+"""
+
+clientside_callback(
+    DEPENDENT_OPTIONS_JS % 'links',
     Output('link_dropdown', 'options'),
     Output('link_dropdown', 'value'),
-    Input('unique_dropdown', 'value')
+    Input('unique_dropdown', 'value'),
+    Input('audit_options', 'data')
 )
-def update_link_dropdown(item_name: str):
-    options = data.loc[data['Name'] == item_name, 'Links'].unique()
-    if not options.size > 0:
-        return [], None
-    return options, options[0]
-
 
-@callback(
+clientside_callback(
+    DEPENDENT_OPTIONS_JS % 'variants',
     Output('num_passives_dropdown', 'options'),
     Output('num_passives_dropdown', 'value'),
-    Input('cluster_type_dropdown', 'value')
+    Input('cluster_type_dropdown', 'value'),
+    Input('audit_options', 'data')
 )
-def update_num_passives_dropdown(cluster_type: str):
-    if not cluster_type:
-        return [], None
-    options = data.loc[data['Name'] == cluster_type, 'Variant'].unique()
-    if not options.size > 0:
-        return [], None
-    return options, options[0]
 
-
-@callback(
+clientside_callback(
+    DEPENDENT_OPTIONS_JS % 'item_levels',
     Output('item_level_dropdown', 'options'),
     Output('item_level_dropdown', 'value'),
-    Input('cluster_type_dropdown', 'value')
+    Input('cluster_type_dropdown', 'value'),
+    Input('audit_options', 'data')
 )
-def update_item_level_dropdown(cluster_type: str):
-    if not cluster_type:
-        return [], None
-    options = data.loc[data['Name'] == cluster_type, 'ItemLevel'].unique()
-    if not options.size > 0:
-        return [], None
-    return options, options[0]
 
 
 @callback(
     Output('unique_price_graph', 'figure'),
     Input('unique_dropdown', 'value'),
-    Input('link_dropdown', 'value')
+    Input('link_dropdown', 'value'),
+    State('league_dropdown', 'value')
 )
-def update_unique_price_graph(selected_item: str, selected_links: str):
-    filtered_data = data.loc[(data['Name'] == selected_item) & (data['Links'] == selected_links)]
-    unique_ids = filtered_data['Id'].unique()
-    item_data = []
-
-    for item_id in unique_ids:
-        id_x_data = filtered_data.loc[filtered_data['Id'] == item_id]
-        id_y_data = filtered_data.loc[filtered_data['Id'] == item_id]
-        item_data.append({'x': id_x_data['Date'], 'y': id_y_data['Value']})
-
-    figure = {
-        'data': item_data
-    }
-
-    return figure
+@timed('lsa_callback_seconds', profile=True, callback='update_unique_price_graph')
+def update_unique_price_graph(selected_item: str, selected_links: str, leagues: list):
+    if not (store := registry.store(selected_leagues(leagues)[0])):
+        return {}
+    return unique_figure(store, selected_item, selected_links)
 
 
 @callback(
     Output('cluster_price_graph', 'figure'),
     Input('cluster_type_dropdown', 'value'),
     Input('num_passives_dropdown', 'value'),
-    Input('item_level_dropdown', 'value')
+    Input('item_level_dropdown', 'value'),
+    State('league_dropdown', 'value')
 )
-def update_cluster_price_graph(selected_type: str, selected_num_passives: str, selected_item_level: float):
+@timed('lsa_callback_seconds', profile=True, callback='update_cluster_price_graph')
+def update_cluster_price_graph(selected_type: str, selected_num_passives: str, selected_item_level: float, leagues: list):
     if not selected_type or not selected_num_passives or not selected_item_level:
         return {}
-    filtered_data = data.loc[(data['Variant'] == selected_num_passives) & (data['Name'] == selected_type) & (data['ItemLevel'] == selected_item_level)]
-
-    figure = {
-        'data': [
-            {
-                'x': filtered_data['Date'],
-                'y': filtered_data['Value']
-            }
-        ]
+    if not (store := registry.store(selected_leagues(leagues)[0])):
+        return {}
+    return cluster_figure(store, selected_type, selected_num_passives, selected_item_level)
+
+
+# Runs in the browser, so the graph figures never travel back to the server just to toggle visibility
+clientside_callback(
+    """
+    function(uniqueFigure, clusterFigure, uniqueOptions, linkOptions, clusterTypeOptions, numPassivesOptions,
+             itemLevelOptions, uniqueTotalCost, clusterTotalCost, pobInput, characterLevelAscendancy) {
+        const shown = (visible) => ({'display': visible ? 'block' : 'none'});
+        const hasData = (figure) => Boolean(figure && figure.data && figure.data.length);
+        const hasItems = (values) => Boolean(values && values.length);
+        return [
+            shown(hasData(uniqueFigure)), shown(hasData(clusterFigure)),
+            shown(hasItems(uniqueOptions)), shown(hasItems(linkOptions)),
+            shown(hasItems(uniqueTotalCost)), shown(hasItems(clusterTotalCost)),
+            shown(hasItems(clusterTypeOptions)), shown(hasItems(numPassivesOptions)), shown(hasItems(itemLevelOptions)),
+            {'color': 'red', 'display': hasItems(characterLevelAscendancy) || !pobInput ? 'none' : 'block'}
+        ];
     }
-
-    return figure
-
-
-@callback(
+    """,
     Output('unique_price_graph', 'style'),
     Output('cluster_price_graph', 'style'),
     Output('unique_dropdown', 'style'),
@@ -308,44 +365,3 @@ def update_cluster_price_graph(selected_type: str, selected_num_passives: str, s
     Input('pob_input', 'value'),
     Input('character_level_ascendancy', 'children')
 )
-def update_visibility(unique_price_graph_figure: dict, cluster_price_graph_figure: dict, 
-                      unique_dropdown_options: list, link_dropdown_options: list, cluster_type_dropdown_options: list,
-                      num_passives_dropdown_options: list, item_level_dropdown_options: list,
-                      unique_total_cost_children: list, cluster_total_cost_children: list, pob_input: str,
-                      character_level_ascendancy_div: list):
-    unique_price_graph_style = {'display': 'block'}
-    cluster_price_graph_style = {'display': 'block'}
-    unique_dropdown_style = {'display': 'block'}
-    link_dropdown_style = {'display': 'block'}
-    cluster_type_dropdown_style = {'display': 'block'}
-    num_passives_dropdown_style = {'display': 'block'}
-    item_level_dropdown_style = {'display': 'block'}
-    uniques_panel_style = {'display': 'block'}
-    clusters_panel_style = {'display': 'block'}
-    error_reading_pob_style = {'color': 'red', 'display': 'block'}
-
-    if not unique_price_graph_figure.get('data', []):
-        unique_price_graph_style['display'] = 'none'
-    if not cluster_price_graph_figure.get('data', []):
-        cluster_price_graph_style['display'] = 'none'
-    if not unique_dropdown_options:
-        unique_dropdown_style['display'] = 'none'
-    if not link_dropdown_options:
-        link_dropdown_style['display'] = 'none'
-    if not cluster_type_dropdown_options:
-        cluster_type_dropdown_style['display'] = 'none'
-    if not num_passives_dropdown_options:
-        num_passives_dropdown_style['display'] = 'none'
-    if not item_level_dropdown_options:
-        item_level_dropdown_style['display'] = 'none'
-    if not unique_total_cost_children:
-        uniques_panel_style['display'] = 'none'
-    if not cluster_total_cost_children:
-        clusters_panel_style['display'] = 'none'
-    if character_level_ascendancy_div or not pob_input:
-        error_reading_pob_style['display'] = 'none'
-
-    return unique_price_graph_style, cluster_price_graph_style, unique_dropdown_style, \
-            link_dropdown_style, uniques_panel_style, clusters_panel_style, cluster_type_dropdown_style, \
-            num_passives_dropdown_style, item_level_dropdown_style, error_reading_pob_style
-
@@ -1,22 +1,20 @@
 import re
-import json
 import zlib
 import base64
 import logging
 import binascii
-import requests
 import numpy as np
 import pandas as pd
 from typing import Optional
 from dataclasses import dataclass
 import xml.etree.ElementTree as ET
 
+from fetcher import default_fetcher
+from clusterids import cluster_levels_path, refresh_cluster_levels
+from metrics import timed
+
 logging.basicConfig(level=logging.INFO)
-BUILD_CODE_PATHS = {
-    'pobb.in': 'https://pobb.in/:id:/raw',
-    'pastebin.com': 'https://pastebin.com/raw/:id:'
-}
-DISPLAY_STATS = [
+DISPLAY_STATS = {
     'AverageHit',
     'AverageDamage',
     'Speed',
@@ -39,86 +37,141 @@ DISPLAY_STATS = [
     'LightningResist',
     'ChaosResist',
     'SpellSuppressionChance'
-]
+}
+CLUSTER_SIZES = {'Large Cluster Jewel', 'Medium Cluster Jewel', 'Small Cluster Jewel'}
+UNIQUE_NAME_R = re.compile(r'^[\w \']+$')
+MOD_TAGS_R = re.compile(r'^(\{[^}]*\})+')
+CLUSTER_PASSIVES_R = re.compile(r'^Adds (?P<num_passives>\d+) Passive Skills$')
+SMALL_PASSIVE_PREFIX = 'Added Small Passive Skills grant: '
+DATA_READ_OPTIONS = {
+    'delimiter': ';',
+    # Names and dates repeat on every day an item is listed, so reading them as categories avoids millions of
+    # duplicate strings, and dates are parsed once per distinct day (see _clean_data)
+    'dtype': {'Date': 'category', 'Type': 'category', 'Name': 'category', 'BaseType': 'category', 'Variant': 'category', 'Links': 'category',
+              'Confidence': 'category', 'Id': np.int32, 'Value': np.float32},
+    'usecols': ['Date', 'Id', 'Type', 'Name', 'BaseType', 'Variant', 'Links', 'Value', 'Confidence']
+}
+DATA_CHUNK_SIZE = 500_000
 
-@dataclass
+@dataclass(slots=True)
 class UniqueItem:
     name: str
 
-@dataclass
+@dataclass(slots=True)
 class ClusterJewel:
     size: str
     level: int
     num_passives: int
     small_passives: str
 
+@dataclass(slots=True)
+class Build:
+    uniques: list
+    clusters: list
+    character: dict
+    display_stats: dict
+
+
+def _clean_data(df: pd.DataFrame) -> pd.DataFrame:
+    dates = df['Date'].cat
+    df['Date'] = dates.rename_categories(pd.to_datetime(dates.categories)).astype('datetime64[ns]')
+    df['Links'] = df['Links'].cat.add_categories('None').fillna('None')
+    return df
+
 
 def load_data(file_name: str) -> pd.DataFrame:
     try:
-        df = pd.read_csv(file_name, delimiter=';', parse_dates=['Date'], dtype={'Type': 'category', 'BaseType': 'category', 'Variant': 'category', 'Links': 'category', 'Confidence': 'category'}, usecols=['Date', 'Id', 'Type', 'Name', 'BaseType', 'Variant', 'Links', 'Value', 'Confidence'])
-        df['Links'] = df['Links'].cat.add_categories('None')
-        df['Links'].fillna('None', inplace=True)
-        return df
+        return _clean_data(pd.read_csv(file_name, **DATA_READ_OPTIONS))
     except FileNotFoundError:
         return pd.DataFrame()
 
 
+def iter_data(file, chunksize: int = DATA_CHUNK_SIZE):
+    # Accepts a path or an open binary stream, such as a member of the dump zip
+    with pd.read_csv(file, chunksize=chunksize, **DATA_READ_OPTIONS) as reader:
+        for chunk in reader:
+            yield _clean_data(chunk)
+
+
+@timed('lsa_stage_seconds', stage='fetch')
 def get_pob_code_from_url(url: str) -> Optional[str]:
-    url_r = re.compile(r'(http(s)?:\/\/)?(www.)?(?P<url_base>\w+\.\w+)\/(?P<paste_id>\w+)')
-    if not (url and (url_match := url_r.search(url))):
-        return None
-    url = BUILD_CODE_PATHS.get(url_match.group('url_base'), '').replace(':id:', url_match.group('paste_id'))
-    if not url:
-        return None
-    resp = requests.get(url)
-    if resp.status_code != 200:
+    return default_fetcher().fetch(url)
+
+
+def _decode_pob_code(pob_code: str) -> Optional[bytes]:
+    try:
+        return base64.urlsafe_b64decode(pob_code)
+    except binascii.Error:
+        logging.error("binascii error converting build code to XML")
         return None
-    return resp.text
 
 
+@timed('lsa_stage_seconds', stage='read_pob_to_xml')
 def read_pob_to_xml(pob_code: str) -> ET.Element:
-    if not pob_code:
+    if not pob_code or not (decoded := _decode_pob_code(pob_code)):
         return None
     try:
-        decoded = base64.urlsafe_b64decode(pob_code)
         decompressed = zlib.decompress(decoded)
     except zlib.error:
         logging.error("zlib error converting build code to XML")
         return None
-    except binascii.Error:
-        logging.error("binascii error converting build code to XML")
-        return None
     else:
         return ET.fromstring(decompressed)
 
 
+def _parse_cluster(size: str, mods: str) -> Optional[ClusterJewel]:
+    item_level = num_passives = None
+    small_passives = []
+    for line in mods.split('\n'):
+        line = line.strip()
+        if line.startswith('{'):
+            line = MOD_TAGS_R.sub('', line)
+        if line.startswith('Item Level: '):
+            item_level = int(line[len('Item Level: '):])
+        elif passives_match := CLUSTER_PASSIVES_R.match(line):
+            num_passives = int(passives_match.group('num_passives'))
+        elif line.startswith(SMALL_PASSIVE_PREFIX):
+            small_passives.append(line[len(SMALL_PASSIVE_PREFIX):])
+    if item_level is None or num_passives is None or not small_passives:
+        return None
+    return ClusterJewel(
+        size=size,
+        level=item_level,
+        num_passives=num_passives,
+        small_passives=', '.join(small_passives)
+    )
+
+
+def parse_item(text: str):
+    # The rarity, name and base lines classify an item, only cluster jewels read the rest
+    head = (text or '').lstrip().split('\n', 3)
+    if len(head) < 3 or not head[0].startswith('Rarity: '):
+        return None
+    if head[0].rstrip() == 'Rarity: UNIQUE':
+        name = head[1].strip()
+        return UniqueItem(name=name) if UNIQUE_NAME_R.match(name) else None
+    if (size := head[2].strip()) in CLUSTER_SIZES:
+        return _parse_cluster(size, head[3] if len(head) > 3 else '')
+    return None
+
+
+@timed('lsa_stage_seconds', stage='get_uniques_from_xml')
 def get_uniques_from_xml(root: ET.Element) -> list:
     items_xml = root.find('Items')
     if not items_xml:
         return []
-    unique = re.compile(r'^Rarity: UNIQUE\n(?P<item_name>[\w \']+)\n')
-
-    return [UniqueItem(
-            name=unique_match.group('item_name')
-        )
-        for item in items_xml if item.tag == 'Item' and (unique_match := unique.match(item.text.strip()))]
+    return [parsed for item in items_xml if item.tag == 'Item' and isinstance(parsed := parse_item(item.text), UniqueItem)]
 
 
+@timed('lsa_stage_seconds', stage='get_clusters_from_xml')
 def get_clusters_from_xml(root: ET.Element) -> list:
     items_xml = root.find('Items')
     if not items_xml:
         return []
-    cluster = re.compile(r'^Rarity: \w+\s+[\w ]+\s+(?P<size>[\w ]+)\s+(Unique ID: [\w\d]+\s+)?Item Level: (?P<item_level>\d+)\s+LevelReq: \d+\s+Implicits: \d\s+{crafted}Adds (?P<num_passives>\d) Passive Skills\s+{crafted}[\w\d ]+\s+{crafted}(?P<small_passives>(Added Small Passive Skills grant: [\w% \d]+\n)+)')
-
-    return [ClusterJewel(
-            size=cluster_match.group('size'),
-            num_passives=int(cluster_match.group('num_passives')),
-            level=int(cluster_match.group('item_level')),
-            small_passives=cluster_match.group('small_passives').strip().replace('\n', ', ').replace('Added Small Passive Skills grant: ', '')
-        )
-        for item in items_xml if item.tag == 'Item' and (cluster_match := cluster.match(item.text.strip()))]
+    return [parsed for item in items_xml if item.tag == 'Item' and isinstance(parsed := parse_item(item.text), ClusterJewel)]
 
 
+@timed('lsa_stage_seconds', stage='get_stats_from_xml')
 def get_stats_from_xml(root: ET.Element) -> tuple:
     stats_root = root.find('Build')
     if not stats_root:
@@ -142,38 +195,69 @@ def get_stats_from_xml(root: ET.Element) -> tuple:
     return character, display_stats
 
 
-def process_cluster_ids(url: str):
-    # https://poe.ninja/api/data/itemoverview?league=Kalandra&type=ClusterJewel&language=en
-    # try:
-    #     with open(file_name, 'r', encoding='utf-8') as cluster_info_file:
-    #         cluster_info_dict = json.loads(cluster_info_file.read())
-    # except IOError as ioe:
-    #     logging.error("Could not read file '%s'", file_name)
-    #     return {}
-    # except json.JSONDecodeError as jde:
-    #     logging.error("Could not decode JSON at '%s'", file_name)
-
-    league_re = re.search("league=(?P<league_name>[A-Za-z]+)", url)
-    
-    if not league_re:
-        logging.error("Couldn't parse league name from URL '%s'", url)
-        return
-
-    league = league_re.group('league_name')
-    resp = requests.get(url)
-
-    if resp.status_code != 200:
-        logging.error("Failed to fetch URL '%s'", url)
-        return
-    
+def _element_span(xml: bytes, tag: bytes) -> Optional[tuple]:
+    # '<' only ever starts markup in XML, so the first '<tag' followed by whitespace or '>' opens the element
+    start = xml.find(b'<' + tag)
+    while start >= 0 and xml[start + len(tag) + 1:start + len(tag) + 2] not in (b' ', b'>', b'\n', b'\t', b'\r'):
+        start = xml.find(b'<' + tag, start + 1)
+    if start < 0:
+        return None
+    end = xml.find(b'</' + tag + b'>', start)
+    return (start, end + len(tag) + 3) if end >= 0 else None
+
+
+def _read_build_element(build_xml: ET.Element, build: Build):
+    build.character['level'] = build_xml.attrib['level']
+    build.character['class'] = build_xml.attrib.get('ascendClassName', build_xml.attrib['className'])
+    for stat in build_xml:
+        if stat.tag == 'PlayerStat':
+            if stat.get('stat') in DISPLAY_STATS:
+                build.display_stats[stat.get('stat')] = float(stat.get('value'))
+        elif stat.tag == 'FullDPSSkill':
+            build.character.setdefault('FullDPSSkill', []).append((stat.get('stat'), float(stat.get('value'))))
+
+
+def _read_items_element(xml: bytes, span: tuple, build: Build):
+    # PoB writes every Item before the item sets, which only reference items by id, so the sets are never parsed
+    body_start = xml.index(b'>', span[0]) + 1
+    body_end = xml.find(b'<ItemSet', body_start, span[1])
+    parser = ET.XMLParser()
+    parser.feed(b'<Items>')
+    parser.feed(memoryview(xml)[body_start:body_end if body_end >= 0 else span[1] - len(b'</Items>')])
+    parser.feed(b'</Items>')
+    for item in parser.close().iterfind('Item'):
+        parsed = parse_item(item.text)
+        if parsed.__class__ is UniqueItem:
+            build.uniques.append(parsed)
+        elif parsed.__class__ is ClusterJewel:
+            build.clusters.append(parsed)
+
+
+@timed('lsa_stage_seconds', stage='parse_build')
+def parse_build(pob_code: str) -> Optional[Build]:
+    if not pob_code or not (decoded := _decode_pob_code(pob_code)):
+        return None
     try:
-        cluster_info_dict = json.loads(resp.text)
-    except json.JSONDecodeError as jde:
-        logging.error("Could not decode JSON from API request")
-    
-    cluster_id_df = pd.DataFrame([(cluster.get('id'), cluster.get('levelRequired')) for cluster in cluster_info_dict['lines']], columns=['Id', 'ItemLevel'])
+        xml = zlib.decompress(decoded)
+    except zlib.error:
+        logging.error("zlib error converting build code to XML")
+        return None
 
-    cluster_id_df.to_csv(f'data/{league}/{league}.clusterjewels.ids.csv', index=False)
+    # Only the Build and Items elements are parsed, the tree, skills, config and item sets are skipped unread
+    build_span, items_span = _element_span(xml, b'Build'), _element_span(xml, b'Items')
+    if not build_span and not items_span:
+        logging.error("Could not parse build XML")
+        return None
+    build = Build(uniques=[], clusters=[], character={}, display_stats={})
+    try:
+        if build_span:
+            _read_build_element(ET.fromstring(xml[build_span[0]:build_span[1]]), build)
+        if items_span:
+            _read_items_element(xml, items_span, build)
+    except (ET.ParseError, KeyError, ValueError):
+        logging.error("Could not parse build XML")
+        return None
+    return build
 
 
 if __name__ == '__main__':
@@ -182,4 +266,4 @@ if __name__ == '__main__':
     # print(get_stats_from_xml(pob_xml))
     # print(get_clusters_from_xml(pob_xml))
     # print(pob_xml)
-    process_cluster_ids('https://poe.ninja/api/data/itemoverview?league=Ancestor&type=ClusterJewel&language=en')
+    refresh_cluster_levels('https://poe.ninja/api/data/itemoverview?league=Ancestor&type=ClusterJewel&language=en', cluster_levels_path('.', 'Ancestor'))
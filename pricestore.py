@@ -0,0 +1,606 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+import logging
+import numpy as np
+import pandas as pd
+from typing import Optional
+from datetime import date
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from pobutils import iter_data
+from clusterids import cluster_levels_path, load_cluster_levels, cluster_item_levels
+from metrics import metrics
+
+STORE_VERSION = 4
+COLUMNS = {
+    'date': np.int16,
+    'id': np.int32,
+    'type': np.int8,
+    'name': np.int32,
+    'base_type': np.int16,
+    'variant': np.int16,
+    'links': np.int8,
+    'value': np.float32,
+    'item_level': np.int8,
+    'confidence': np.int8
+}
+DICTIONARY_COLUMNS = {
+    'type': 'Type',
+    'name': 'Name',
+    'base_type': 'BaseType',
+    'variant': 'Variant',
+    'links': 'Links',
+    'confidence': 'Confidence'
+}
+# Rows are stored sorted by (name, date), so the name index needs no row permutation
+INDEXES = {
+    'name': ('name',),
+    'name_links_id': ('name', 'links', 'id'),
+    'cluster': ('base_type', 'variant', 'name', 'item_level')
+}
+SUMMARY_KEYS = ('name', 'links', 'variant', 'item_level')
+SUMMARY_DAYS = (1, 3, 7, 14)
+STORE_CHECK_INTERVAL = 30
+# Price sketches: confidence-weighted histograms over log-spaced price bins, per (name, variant, item level, day)
+SKETCH_KEYS = ('name', 'variant', 'item_level')
+SKETCH_DAYS = 15
+SKETCH_EDGES = np.geomspace(0.1, 1e6, 257)
+CONFIDENCE_WEIGHTS = {'High': 1.0, 'Medium': 0.5, 'Low': 0.25}
+DEFAULT_CONFIDENCE_WEIGHT = 0.5
+
+
+@dataclass
+class ItemSummary:
+    links: Optional[str]
+    variant: Optional[str]
+    item_level: Optional[int]
+    first_date: date
+    first_value: float
+    min_value: float
+    max_value: float
+    day_values: dict
+    pct_changes: dict
+
+
+def items_path(root_dir: str, league: str) -> str:
+    return os.path.join(root_dir, f'data/{league}/{league}.items.csv')
+
+
+def cluster_ids_path(root_dir: str, league: str) -> str:
+    return cluster_levels_path(root_dir, league)
+
+
+def store_path(root_dir: str, league: str) -> str:
+    return os.path.join(root_dir, f'data/{league}/{league}.store')
+
+
+def dump_path(root_dir: str, league: str) -> str:
+    return os.path.join(root_dir, f'data/{league}/{league}.zip')
+
+
+def has_price_data(root_dir: str, league: str) -> bool:
+    # Anything load_price_store can open or rebuild a store from
+    return os.path.isdir(store_path(root_dir, league)) or os.path.isfile(items_path(root_dir, league)) or os.path.isfile(dump_path(root_dir, league))
+
+
+def _encode(series: pd.Series, dictionary: list) -> np.ndarray:
+    # Unseen values are appended to the dictionary, missing values get code -1 so they decode to None (see PriceStore.decode)
+    lookup = {value: code for code, value in enumerate(dictionary)}
+
+    def code_for(value) -> int:
+        value = str(value)
+        if value not in lookup:
+            lookup[value] = len(dictionary)
+            dictionary.append(value)
+        return lookup[value]
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series)
+    # Index -1 picks the trailing -1, so missing values keep their code
+    return np.array([code_for(value) for value in uniques] + [-1], dtype=np.int64)[codes]
+
+
+def _build_index(columns: dict, keys: tuple, rows: Optional[np.ndarray] = None) -> dict:
+    key_columns = [np.asarray(columns[key])[rows] if rows is not None else np.asarray(columns[key]) for key in keys]
+    if rows is not None:
+        # lexsort is stable, so rows within a group keep their date order
+        order = np.lexsort(key_columns[::-1])
+        rows = rows[order]
+        key_columns = [column[order] for column in key_columns]
+    key_matrix = np.stack(key_columns, axis=1).astype(np.int32) if key_columns[0].size else np.empty((0, len(keys)), dtype=np.int32)
+    starts = np.flatnonzero(np.r_[True, np.any(key_matrix[1:] != key_matrix[:-1], axis=1)]) if len(key_matrix) else np.empty(0, dtype=np.int64)
+    index = {
+        'keys': key_matrix[starts],
+        'bounds': np.r_[starts, len(key_matrix)].astype(np.int64)
+    }
+    if rows is not None:
+        index['rows'] = rows.astype(np.int32)
+    return index
+
+
+def _build_summary(columns: dict, days: tuple) -> dict:
+    df = pd.DataFrame({column: columns[column] for column in SUMMARY_KEYS + ('date', 'value')})
+    # Rows are sorted by (name, date), so the first row of every group is its first observation
+    grouped = df.groupby(list(SUMMARY_KEYS), sort=True)
+    groups = grouped.agg(first_date=('date', 'first'), first_value=('value', 'first'), min_value=('value', 'min'), max_value=('value', 'max'))
+
+    df['group'] = grouped.ngroup()
+    df['offset'] = df['date'] - groups['first_date'].to_numpy()[df['group'].to_numpy()]
+    day_values = df.loc[df['offset'].isin(days)] \
+        .drop_duplicates(['group', 'offset']) \
+        .pivot(index='group', columns='offset', values='value') \
+        .reindex(index=range(len(groups)), columns=list(days))
+
+    summary = {
+        'keys': np.asarray(groups.index.to_frame(index=False), dtype=np.int32),
+        'first_date': groups['first_date'].to_numpy(dtype=np.int16),
+        'first_value': groups['first_value'].to_numpy(dtype=np.float32),
+        'min_value': groups['min_value'].to_numpy(dtype=np.float32),
+        'max_value': groups['max_value'].to_numpy(dtype=np.float32)
+    }
+    for day in days:
+        summary[f'day_{day}_value'] = day_values[day].to_numpy(dtype=np.float32)
+    return summary
+
+
+def _encode_chunk(df: pd.DataFrame, cluster_levels: np.ndarray, dictionaries: dict) -> dict:
+    # Dates stay as days since the epoch until every chunk is read and the league start is known
+    columns = {
+        'date': df['Date'].to_numpy(dtype='datetime64[D]').astype(np.int32),
+        'id': df['Id'],
+        'value': df['Value'],
+        'item_level': cluster_item_levels(cluster_levels, df['Id'].to_numpy(), df['Type'].to_numpy())
+    }
+    for column, source in DICTIONARY_COLUMNS.items():
+        columns[column] = _encode(df[source], dictionaries[column])
+    return {column: np.asarray(values).astype(np.int32 if column == 'date' else COLUMNS[column]) for column, values in columns.items()}
+
+
+def _store_generations(store_dir: str) -> list:
+    parent, prefix = os.path.split(store_dir)
+    if not os.path.isdir(parent):
+        return []
+    return sorted(int(entry[len(prefix) + 1:]) for entry in os.listdir(parent)
+                  if entry.startswith(f'{prefix}.') and entry[len(prefix) + 1:].isdigit())
+
+
+_held_store_locks = threading.local()
+
+
+@contextmanager
+def store_lock(store_dir: str):
+    # Serialises rebuilds of one league's store across processes, the OS releases the lock if its holder dies.
+    # Reentrant per thread, so a rebuild holding it can ingest and write without deadlocking on itself
+    held = _held_store_locks.__dict__.setdefault('dirs', set())
+    if store_dir in held:
+        yield
+        return
+    os.makedirs(os.path.dirname(store_dir) or '.', exist_ok=True)
+    with open(f'{store_dir}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held.add(store_dir)
+        try:
+            yield
+        finally:
+            held.discard(store_dir)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _build_sketches(columns: dict, dictionaries: dict, days: int = SKETCH_DAYS) -> dict:
+    # Links are left out of the key, so every links variant of an item feeds the same distribution
+    rows = np.flatnonzero(columns['date'] < days)
+    weights = np.array([CONFIDENCE_WEIGHTS.get(value, DEFAULT_CONFIDENCE_WEIGHT) for value in dictionaries['confidence']] + [DEFAULT_CONFIDENCE_WEIGHT],
+                       dtype=np.float32)[columns['confidence'][rows]]
+    bins = np.clip(np.searchsorted(SKETCH_EDGES, columns['value'][rows], side='right') - 1, 0, len(SKETCH_EDGES) - 2)
+    df = pd.DataFrame({key: columns[key][rows] for key in SKETCH_KEYS + ('date',)}).assign(bin=bins, weight=weights)
+    sketch = df.groupby(list(SKETCH_KEYS) + ['date', 'bin'], sort=True)['weight'].sum().reset_index()
+
+    key_matrix = sketch[list(SKETCH_KEYS)].to_numpy(dtype=np.int32)
+    starts = np.flatnonzero(np.r_[True, np.any(key_matrix[1:] != key_matrix[:-1], axis=1)]) if len(key_matrix) else np.empty(0, dtype=np.int64)
+    return {
+        'keys': key_matrix[starts] if len(key_matrix) else np.empty((0, len(SKETCH_KEYS)), dtype=np.int32),
+        'bounds': np.r_[starts, len(key_matrix)].astype(np.int64),
+        'day': sketch['date'].to_numpy(dtype=np.int16),
+        'bin': sketch['bin'].to_numpy(dtype=np.uint8),
+        'weight': sketch['weight'].to_numpy(dtype=np.float32),
+        'edges': SKETCH_EDGES
+    }
+
+
+def sketch_quantiles(histogram: np.ndarray, edges: np.ndarray, quantiles: tuple) -> Optional[tuple]:
+    # Interpolates log-linearly inside the bin a quantile falls in, matching the log-spaced edges
+    total = histogram.sum()
+    if total <= 0:
+        return None
+    cumulative = np.cumsum(histogram) / total
+    bins = np.minimum(np.searchsorted(cumulative, quantiles, side='left'), len(histogram) - 1)
+    below = np.where(bins > 0, cumulative[bins - 1], 0.0)
+    fraction = np.clip((np.asarray(quantiles) - below) / np.maximum(cumulative[bins] - below, 1e-12), 0.0, 1.0)
+    log_edges = np.log(edges)
+    return tuple(np.exp(log_edges[bins] + fraction * (log_edges[bins + 1] - log_edges[bins])).tolist())
+
+
+def sketch_sum(histograms: list, edges: np.ndarray) -> np.ndarray:
+    # Distribution of the sum of independent prices: each pair of bins adds at its geometric midpoint,
+    # and the sums are re-binned onto the same log-spaced edges, so one histogram is convolved in at a time
+    midpoints = np.sqrt(edges[:-1] * edges[1:])
+    total = None
+    for histogram in histograms:
+        if (weight := histogram.sum()) <= 0:
+            continue
+        if total is None:
+            total = histogram / weight
+            continue
+        left, right = np.flatnonzero(total), np.flatnonzero(histogram)
+        sums = (midpoints[left, None] + midpoints[None, right]).ravel()
+        bins = np.clip(np.searchsorted(edges, sums, side='right') - 1, 0, len(midpoints) - 1)
+        total = np.bincount(bins, weights=(total[left, None] * histogram[None, right] / weight).ravel(), minlength=len(midpoints))
+    return total if total is not None else np.zeros(len(midpoints), dtype=np.float64)
+
+
+def _write_store(columns: dict, dictionaries: dict, store_dir: str, summary_days: tuple):
+    start_day = int(columns['date'].min())
+    columns['date'] = columns['date'] - start_day
+    columns = {column: values.astype(COLUMNS[column]) for column, values in columns.items()}
+    rows = len(columns['date'])
+
+    order = np.lexsort((columns['date'], columns['name']))
+    columns = {column: values[order] for column, values in columns.items()}
+    indexes = {
+        'name': _build_index(columns, INDEXES['name']),
+        'name_links_id': _build_index(columns, INDEXES['name_links_id'], np.arange(rows)),
+        'cluster': _build_index(columns, INDEXES['cluster'], np.flatnonzero(columns['item_level'] >= 0))
+    }
+    summary = _build_summary(columns, summary_days)
+    sketches = _build_sketches(columns, dictionaries)
+
+    # Every write goes to a new generation directory, which a symlink swap then publishes atomically.
+    # Writers take the league's lock, and a directory left by a crashed writer is skipped rather than removed
+    with store_lock(store_dir):
+        generation = max(_store_generations(store_dir), default=0) + 1
+        while True:
+            generation_dir = f'{store_dir}.{generation}'
+            try:
+                os.makedirs(generation_dir, exist_ok=False)
+                break
+            except FileExistsError:
+                generation += 1
+        for column, values in columns.items():
+            np.save(os.path.join(generation_dir, f'{column}.npy'), values)
+        for index_name, index in indexes.items():
+            for part, values in index.items():
+                np.save(os.path.join(generation_dir, f'index.{index_name}.{part}.npy'), values)
+        for part, values in summary.items():
+            np.save(os.path.join(generation_dir, f'summary.{part}.npy'), values)
+        for part, values in sketches.items():
+            np.save(os.path.join(generation_dir, f'sketch.{part}.npy'), values)
+        start_date = np.datetime64(start_day, 'D')
+        with open(os.path.join(generation_dir, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump({
+                'version': STORE_VERSION,
+                'generation': generation,
+                'rows': rows,
+                'start_date': str(start_date),
+                'latest_date': str(start_date + int(columns['date'].max())),
+                'summary_days': list(summary_days),
+                'dictionaries': dictionaries
+            }, meta_file)
+
+        if os.path.isdir(store_dir) and not os.path.islink(store_dir):
+            shutil.rmtree(store_dir)
+        link_tmp = f'{store_dir}.link.tmp'
+        if os.path.lexists(link_tmp):
+            os.remove(link_tmp)
+        os.symlink(os.path.basename(generation_dir), link_tmp)
+        os.replace(link_tmp, store_dir)
+
+        # Keep the previous generation around for readers that resolved the link just before the swap
+        for old_generation in _store_generations(store_dir)[:-2]:
+            shutil.rmtree(f'{store_dir}.{old_generation}', ignore_errors=True)
+    logging.info("Wrote %d rows to price store '%s'", rows, generation_dir)
+
+
+def append_price_store(chunks, cluster_ids_file: str, store_dir: str, base: Optional['PriceStore'] = None,
+                       summary_days: tuple = SUMMARY_DAYS) -> int:
+    cluster_levels = load_cluster_levels(cluster_ids_file)
+    dictionaries = {column: list(base.dictionaries[column][:-1]) if base else [] for column in DICTIONARY_COLUMNS}
+    latest_date = pd.Timestamp(base.latest_date) if base else None
+
+    parts = []
+    for chunk in chunks:
+        if latest_date is not None:
+            chunk = chunk.loc[chunk['Date'] > latest_date]
+        if len(chunk):
+            parts.append(_encode_chunk(chunk, cluster_levels, dictionaries))
+    new_rows = sum(len(part['date']) for part in parts)
+    if not new_rows:
+        return 0
+
+    if base:
+        parts.insert(0, {column: np.asarray(base.columns[column]) for column in COLUMNS})
+        parts[0]['date'] = parts[0]['date'].astype(np.int32) + int(base.start_date.astype(np.int32))
+    columns = {column: np.concatenate([part[column] for part in parts]) for column in COLUMNS}
+    _write_store(columns, dictionaries, store_dir, base.summary_days if base else summary_days)
+    return new_rows
+
+
+def build_price_store(items_file: str, cluster_ids_file: str, store_dir: str, summary_days: tuple = SUMMARY_DAYS) -> bool:
+    try:
+        new_rows = append_price_store(iter_data(items_file), cluster_ids_file, store_dir, summary_days=summary_days)
+    except FileNotFoundError:
+        new_rows = 0
+    if not new_rows:
+        logging.error("Could not read item data from '%s'", items_file)
+        return False
+    return True
+
+
+class GroupIndex:
+    def __init__(self, keys: tuple, key_values: np.ndarray, bounds: np.ndarray, rows: Optional[np.ndarray] = None):
+        self.keys = keys
+        self.key_values = key_values
+        self.bounds = bounds
+        self.rows = rows
+        # Map every key prefix to the range of (possibly permuted) rows it covers
+        self.prefixes = {}
+        for length in range(1, len(keys) + 1):
+            prefix_values = key_values[:, :length]
+            group_starts = np.flatnonzero(np.r_[True, np.any(prefix_values[1:] != prefix_values[:-1], axis=1)]) if len(prefix_values) else np.empty(0, dtype=np.int64)
+            group_stops = np.r_[group_starts[1:], len(prefix_values)]
+            self.prefixes.update(zip(map(tuple, prefix_values[group_starts].tolist()), zip(bounds[group_starts].tolist(), bounds[group_stops].tolist())))
+
+    def lookup(self, *key) -> np.ndarray:
+        start, stop = self.prefixes.get(key, (0, 0))
+        if self.rows is None:
+            return np.arange(start, stop)
+        return np.asarray(self.rows[start:stop], dtype=np.int64)
+
+
+class ClusterLevels:
+    def __init__(self, key_values: np.ndarray):
+        # Cluster index keys are sorted by (base_type, variant, name, item_level), so numbering every
+        # (base_type, variant, name) group and packing the level into the low byte gives one sorted array
+        prefixes = key_values[:, :3]
+        starts = np.flatnonzero(np.r_[True, np.any(prefixes[1:] != prefixes[:-1], axis=1)]) if len(prefixes) else np.empty(0, dtype=np.int64)
+        self.groups = dict(zip(map(tuple, prefixes[starts].tolist()), range(len(starts))))
+        group_ids = np.cumsum(np.isin(np.arange(len(prefixes)), starts)) - 1
+        self.keys = group_ids.astype(np.int64) * 256 + key_values[:, 3].astype(np.int64)
+
+    def resolve(self, prefixes: list, levels: list) -> np.ndarray:
+        # Highest priced item level strictly below each jewel's level, or -1 where none exists
+        groups = np.array([self.groups.get(prefix, -1) for prefix in prefixes], dtype=np.int64)
+        queries = groups * 256 + np.clip(np.asarray(levels, dtype=np.int64) - 1, -1, 255)
+        matches = np.searchsorted(self.keys, queries, side='right') - 1
+        found = (groups >= 0) & (matches >= 0)
+        found[found] &= self.keys[matches[found]] // 256 == groups[found]
+        return np.where(found, self.keys[np.maximum(matches, 0)] % 256 if len(self.keys) else -1, -1)
+
+
+class PriceStore:
+    def __init__(self, store_dir: str):
+        with open(os.path.join(store_dir, 'meta.json'), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported price store version {meta.get('version')} in '{store_dir}'")
+
+        self.store_dir = store_dir
+        self.generation = meta.get('generation', 0)
+        self.rows = meta['rows']
+        self.start_date = np.datetime64(meta['start_date'], 'D')
+        # Columns are memory-mapped read-only, so forked workers share the same pages
+        self.columns = {column: np.load(os.path.join(store_dir, f'{column}.npy'), mmap_mode='r') for column in COLUMNS}
+        self.latest_date = np.datetime64(meta['latest_date'], 'D') if 'latest_date' in meta else self.start_date + int(self.columns['date'].max())
+        # A trailing None makes code -1 decode to a missing value
+        self.dictionaries = {column: np.array(values + [None], dtype=object) for column, values in meta['dictionaries'].items()}
+        self.codes = {column: {value: code for code, value in enumerate(values)} for column, values in meta['dictionaries'].items()}
+        self.indexes = {index_name: self._load_index(index_name, keys) for index_name, keys in INDEXES.items()}
+        self.cluster_levels = ClusterLevels(self.indexes['cluster'].key_values)
+        self.summary_days = tuple(meta['summary_days'])
+        self.summary = {part: np.load(os.path.join(store_dir, f'summary.{part}.npy')) for part in ['keys', 'first_date', 'first_value', 'min_value', 'max_value'] + [f'day_{day}_value' for day in self.summary_days]}
+        # Summary groups are sorted by name first, so every name covers a contiguous range of groups
+        summary_names = self.summary['keys'][:, 0]
+        name_codes = np.unique(summary_names)
+        self.summary_ranges = dict(zip(name_codes.tolist(), zip(np.searchsorted(summary_names, name_codes, side='left').tolist(), np.searchsorted(summary_names, name_codes, side='right').tolist())))
+        self.sketch = {part: np.load(os.path.join(store_dir, f'sketch.{part}.npy')) for part in ('keys', 'bounds', 'day', 'bin', 'weight', 'edges')}
+
+    @property
+    def nbytes(self) -> int:
+        arrays = list(self.columns.values()) + list(self.summary.values()) + list(self.sketch.values())
+        for index in self.indexes.values():
+            arrays += [index.bounds] + ([index.rows] if index.rows is not None else [])
+        return sum(array.nbytes for array in arrays)
+
+    def _load_index(self, index_name: str, keys: tuple) -> GroupIndex:
+        def load(part, mmap_mode=None):
+            path = os.path.join(self.store_dir, f'index.{index_name}.{part}.npy')
+            return np.load(path, mmap_mode=mmap_mode) if os.path.isfile(path) else None
+        return GroupIndex(keys, load('keys'), load('bounds'), load('rows', mmap_mode='r'))
+
+    def code(self, column: str, value) -> Optional[int]:
+        if column not in DICTIONARY_COLUMNS:
+            return value
+        return self.codes[column].get(value)
+
+    def select(self, **criteria) -> np.ndarray:
+        codes = {}
+        for column, value in criteria.items():
+            codes[column] = self.code(column, value)
+            if codes[column] is None:
+                return np.empty(0, dtype=np.int64)
+
+        # Use the index whose key order covers the longest prefix of the criteria
+        best_index, best_length = None, 0
+        for index in self.indexes.values():
+            length = 0
+            while length < len(index.keys) and index.keys[length] in codes:
+                length += 1
+            if length > best_length:
+                best_index, best_length = index, length
+
+        if best_index:
+            rows = best_index.lookup(*(codes[key] for key in best_index.keys[:best_length]))
+            remaining = {column: code for column, code in codes.items() if column not in best_index.keys[:best_length]}
+        else:
+            rows = np.arange(self.rows)
+            remaining = codes
+        metrics.inc('lsa_rows_scanned_total', len(rows), index='_'.join(best_index.keys[:best_length]) if best_index else 'full_scan')
+        if remaining:
+            mask = np.ones(len(rows), dtype=bool)
+            for column, code in remaining.items():
+                mask &= self.columns[column][rows] == code
+            rows = rows[mask]
+        return rows
+
+    def summarise(self, name: str, **criteria) -> Optional[ItemSummary]:
+        name_code = self.code('name', name)
+        start, stop = self.summary_ranges.get(name_code, (0, 0))
+        groups = np.arange(start, stop)
+        for column, value in criteria.items():
+            # As in price_histogram, None selects the groups missing that value
+            code = -1 if value is None else self.code(column, value)
+            if code is None:
+                return None
+            groups = groups[self.summary['keys'][groups, SUMMARY_KEYS.index(column)] == code]
+        if not groups.size:
+            return None
+
+        # Several link/variant groups may match, report the one observed first
+        group = groups[np.argmin(self.summary['first_date'][groups])]
+        links, variant, item_level = self.summary['keys'][group, 1:].tolist()
+        first_value = float(self.summary['first_value'][group])
+        day_values = {}
+        pct_changes = {}
+        for day in self.summary_days:
+            value = float(self.summary[f'day_{day}_value'][group])
+            day_values[day] = None if np.isnan(value) else value
+            pct_changes[day] = None if np.isnan(value) or not first_value else (value - first_value) / first_value * 100
+        return ItemSummary(
+            links=self.dictionaries['links'][links],
+            variant=self.dictionaries['variant'][variant],
+            item_level=item_level if item_level >= 0 else None,
+            first_date=(self.start_date + np.timedelta64(int(self.summary['first_date'][group]), 'D')).astype(date),
+            first_value=first_value,
+            min_value=float(self.summary['min_value'][group]),
+            max_value=float(self.summary['max_value'][group]),
+            day_values=day_values,
+            pct_changes=pct_changes
+        )
+
+    def price_histogram(self, name: str, days: tuple = (0, 7), **criteria) -> np.ndarray:
+        # Confidence-weighted listings per price bin over league days [days[0], days[1]], summed across links
+        histogram = np.zeros(len(self.sketch['edges']) - 1, dtype=np.float64)
+        name_code = self.code('name', name)
+        if name_code is None:
+            return histogram
+        keys = self.sketch['keys']
+        start, stop = np.searchsorted(keys[:, 0], name_code, side='left'), np.searchsorted(keys[:, 0], name_code, side='right')
+        groups = np.arange(start, stop)
+        for column, value in criteria.items():
+            # None selects the groups missing that value, such as uniques without a variant
+            if (code := -1 if value is None else self.code(column, value)) is None:
+                return histogram
+            groups = groups[keys[groups, SKETCH_KEYS.index(column)] == code]
+        for group in groups.tolist():
+            lo, hi = self.sketch['bounds'][group], self.sketch['bounds'][group + 1]
+            in_window = (self.sketch['day'][lo:hi] >= days[0]) & (self.sketch['day'][lo:hi] <= days[1])
+            histogram += np.bincount(self.sketch['bin'][lo:hi][in_window], weights=self.sketch['weight'][lo:hi][in_window], minlength=len(histogram))
+        return histogram
+
+    def price_quantiles(self, name: str, days: tuple = (0, 7), quantiles: tuple = (0.5, 0.9), **criteria) -> Optional[tuple]:
+        histogram = self.price_histogram(name, days, **criteria)
+        return sketch_quantiles(histogram, self.sketch['edges'], quantiles)
+
+    def resolve_cluster_levels(self, clusters: list) -> list:
+        # clusters holds (base_type, variant, name, item_level) tuples, all resolved in one batched search
+        prefixes = [tuple(self.codes[column].get(value, -1) for column, value in zip(('base_type', 'variant', 'name'), cluster[:3])) for cluster in clusters]
+        levels = self.cluster_levels.resolve(prefixes, [cluster[3] for cluster in clusters])
+        return [int(level) if level >= 0 else None for level in levels.tolist()]
+
+    def decode(self, column: str, rows: np.ndarray) -> np.ndarray:
+        return self.dictionaries[column][self.columns[column][rows]]
+
+    def dates(self, rows: np.ndarray) -> np.ndarray:
+        return self.start_date + self.columns['date'][rows].astype('timedelta64[D]')
+
+    def frame(self, rows: np.ndarray) -> pd.DataFrame:
+        item_levels = self.columns['item_level'][rows].astype(np.float64)
+        item_levels[item_levels < 0] = np.nan
+        return pd.DataFrame({
+            'Date': self.dates(rows).astype('datetime64[ns]'),
+            'Id': self.columns['id'][rows],
+            'Type': self.decode('type', rows),
+            'Name': self.decode('name', rows),
+            'BaseType': self.decode('base_type', rows),
+            'Variant': self.decode('variant', rows),
+            'Links': self.decode('links', rows),
+            'Value': self.columns['value'][rows].astype(np.float64),
+            'ItemLevel': item_levels
+        })
+
+
+def _open_current(store_dir: str, log_stale: bool = False) -> Optional[PriceStore]:
+    if not os.path.isdir(store_dir):
+        return None
+    try:
+        # Open the resolved generation so a concurrent swap cannot mix files from two generations
+        return PriceStore(os.path.realpath(store_dir))
+    except ValueError as ve:
+        if log_stale:
+            logging.warning("%s, rebuilding...", ve)
+        return None
+
+
+def load_price_store(root_dir: str, league: str) -> Optional[PriceStore]:
+    store_dir = store_path(root_dir, league)
+    if store := _open_current(store_dir):
+        return store
+    with store_lock(store_dir):
+        # Another process may have rebuilt the store while this one waited for the lock
+        if store := _open_current(store_dir, log_stale=True):
+            return store
+        if os.path.isfile(items_path(root_dir, league)):
+            logging.info("Converting item data for %s to price store...", league)
+            if not build_price_store(items_path(root_dir, league), cluster_ids_path(root_dir, league), store_dir):
+                return None
+        elif os.path.isfile(dump_path(root_dir, league)):
+            # Ingested leagues keep only the downloaded dump, so the store is rebuilt from that
+            logging.info("Rebuilding price store for %s from '%s'...", league, dump_path(root_dir, league))
+            from ingest import ingest_dump
+            if not ingest_dump(dump_path(root_dir, league), cluster_ids_path(root_dir, league), store_dir):
+                return None
+        else:
+            logging.error("No item data or dump to build the %s price store from, re-run 'python setup.py'", league)
+            return None
+        return PriceStore(os.path.realpath(store_dir))
+
+
+class PriceStoreHandle:
+    def __init__(self, root_dir: str, league: str, check_interval: float = STORE_CHECK_INTERVAL):
+        self.root_dir = root_dir
+        self.league = league
+        self.check_interval = check_interval
+        self.store = load_price_store(root_dir, league)
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[PriceStore]:
+        # Pick up a newly ingested generation without restarting the server
+        if time.monotonic() - self._checked < self.check_interval:
+            return self.store
+        with self._lock:
+            self._checked = time.monotonic()
+            store_dir = store_path(self.root_dir, self.league)
+            if self.store and os.path.isdir(store_dir) and os.path.realpath(store_dir) != self.store.store_dir:
+                try:
+                    self.store = PriceStore(os.path.realpath(store_dir))
+                    logging.info("Loaded price store generation %d for %s", self.store.generation, self.league)
+                except (OSError, ValueError) as e:
+                    logging.error("Could not load new price store for %s: %s", self.league, e)
+        return self.store
@@ -0,0 +1,141 @@
+import json
+import hashlib
+from typing import Optional
+from datetime import date
+from dataclasses import dataclass, field, asdict
+
+from cache import LRUCache
+from metrics import timed
+from pobutils import Build, ClusterJewel
+from pricestore import PriceStore, sketch_quantiles, sketch_sum
+
+AUDIT_CACHE_SIZE = 1024
+WEEK1_DAY = 7
+# League days whose confidence-weighted price distribution is summarised, both ends included
+WINDOW_DAYS = (0, 7)
+WINDOW_QUANTILES = (0.5, 0.9)
+
+
+@dataclass
+class PricedItem:
+    name: str
+    lookup_name: str
+    first_price: Optional[int] = None
+    first_seen: Optional[date] = None
+    week1_price: Optional[float] = None
+    week1_change: Optional[float] = None
+    window_median: Optional[float] = None
+    window_p90: Optional[float] = None
+
+    @property
+    def priced(self) -> bool:
+        return self.first_price is not None
+
+
+@dataclass
+class AuditResult:
+    character: dict
+    display_stats: dict
+    uniques: list = field(default_factory=list)
+    clusters: list = field(default_factory=list)
+    unique_total: int = 0
+    cluster_total: int = 0
+    week1_total: float = 0.0
+    unique_window_median: float = 0.0
+    unique_window_p90: float = 0.0
+    cluster_window_median: float = 0.0
+    cluster_window_p90: float = 0.0
+    window_median: float = 0.0
+    window_p90: float = 0.0
+
+    @property
+    def unique_options(self) -> list:
+        return list(dict.fromkeys(item.lookup_name for item in self.uniques if item.priced))
+
+    @property
+    def cluster_options(self) -> list:
+        return list(dict.fromkeys(item.lookup_name for item in self.clusters))
+
+
+def audit_to_dict(result: AuditResult) -> dict:
+    record = asdict(result)
+    for item in record['uniques'] + record['clusters']:
+        item['first_seen'] = item['first_seen'].isoformat() if item['first_seen'] else None
+    return record
+
+
+def build_key(build: Build) -> str:
+    return hashlib.sha256(json.dumps(asdict(build), sort_keys=True).encode()).hexdigest()
+
+
+def cluster_variant(cluster: ClusterJewel) -> str:
+    return "{} passives".format(cluster.num_passives)
+
+
+def price_item(store: PriceStore, name: str, lookup_name: str, **criteria) -> tuple:
+    # Returns the item with its day window histogram, which build totals are combined from
+    item = PricedItem(name=name, lookup_name=lookup_name)
+    if any(value is None for value in criteria.values()):
+        return item, None
+    summary = store.summarise(lookup_name, **criteria)
+    if not summary:
+        return item, None
+    item.first_price = round(summary.first_value)
+    item.first_seen = summary.first_date
+    item.week1_price = summary.day_values.get(WEEK1_DAY)
+    item.week1_change = summary.pct_changes.get(WEEK1_DAY)
+    # Sketches are not split by links, but are narrowed to the variant of the group the first price came from
+    histogram = store.price_histogram(lookup_name, WINDOW_DAYS, **dict(criteria, variant=summary.variant))
+    if quantiles := sketch_quantiles(histogram, store.sketch['edges'], WINDOW_QUANTILES):
+        item.window_median, item.window_p90 = quantiles
+    return item, histogram
+
+
+def window_quantiles(store: PriceStore, histograms: list) -> tuple:
+    # Quantiles of a total come from the distribution of the summed prices, not from summing item quantiles
+    return sketch_quantiles(sketch_sum(histograms, store.sketch['edges']), store.sketch['edges'], WINDOW_QUANTILES) or (0.0, 0.0)
+
+
+@timed('lsa_stage_seconds', stage='price')
+def audit_build(store: PriceStore, build: Build) -> AuditResult:
+    result = AuditResult(character=build.character, display_stats=build.display_stats)
+    histograms = {'unique': [], 'cluster': []}
+    for unique in build.uniques:
+        item, histogram = price_item(store, unique.name, unique.name)
+        result.uniques.append(item)
+        histograms['unique'].append(histogram)
+    item_levels = store.resolve_cluster_levels([(cluster.size, cluster_variant(cluster), cluster.small_passives, cluster.level) for cluster in build.clusters])
+    for cluster, item_level in zip(build.clusters, item_levels):
+        name = '{}, {}, {} passives'.format(cluster.small_passives, cluster.size, cluster.num_passives)
+        if item_level is not None:
+            name += ', Level {:0.0f}'.format(item_level)
+        item, histogram = price_item(store, name, cluster.small_passives, variant=cluster_variant(cluster), item_level=item_level)
+        result.clusters.append(item)
+        histograms['cluster'].append(histogram)
+
+    result.unique_total = sum(item.first_price for item in result.uniques if item.priced)
+    result.cluster_total = sum(item.first_price for item in result.clusters if item.priced)
+    result.week1_total = sum(item.week1_price for item in result.uniques + result.clusters if item.week1_price is not None)
+    for kind, kind_histograms in histograms.items():
+        median, p90 = window_quantiles(store, [histogram for histogram in kind_histograms if histogram is not None])
+        setattr(result, f'{kind}_window_median', median)
+        setattr(result, f'{kind}_window_p90', p90)
+    result.window_median, result.window_p90 = window_quantiles(store, [histogram for histogram in histograms['unique'] + histograms['cluster'] if histogram is not None])
+    return result
+
+
+class PricingEngine:
+    def __init__(self, store: PriceStore, cache_size: int = AUDIT_CACHE_SIZE):
+        self.store = store
+        self.cache = LRUCache(maxsize=cache_size, name='audit')
+
+    def audit_build(self, build: Build, key: Optional[str] = None) -> AuditResult:
+        key = key or build_key(build)
+        if (result := self.cache.get(key)) is not None:
+            return result
+        result = audit_build(self.store, build)
+        self.cache.set(key, result)
+        return result
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -0,0 +1,5 @@
+import os
+
+# Kept free of third-party imports so light tools (setup, the cluster id refresh) start quickly
+LEAGUE = 'Affliction'
+ROOT_DIR = os.path.dirname(__file__)
@@ -1,28 +1,14 @@
-from requests import get
-from os.path import realpath, dirname, isdir
-from zipfile import ZipFile
-from io import BytesIO
-
-from pobutils import process_cluster_ids
-from main import LEAGUE
+from settings import LEAGUE, ROOT_DIR
 
 def main():
     print("Beginning setup")
-    
-    root_dir = dirname(realpath(__file__))
-    
-    if isdir(f"{root_dir}/data/{LEAGUE}"):
-        print("Data already found, skipping...")
-        return
 
-    print(f"Retrieving economy data for {LEAGUE}...")
-    resp = get(f"https://poe.ninja/api/data/getdump?name={LEAGUE}", stream=True)
+    # Imported here so that importing setup does not pull in pandas
+    from ingest import ingest_league
 
-    print("Decompressing data...")
-    ZipFile(BytesIO(resp.content)).extractall(f"{root_dir}/data/{LEAGUE}")
-    
-    print("Processing cluster jewel data...")
-    process_cluster_ids(f'https://poe.ninja/api/data/itemoverview?league={LEAGUE}&type=ClusterJewel&language=en')
+    print(f"Ingesting economy data for {LEAGUE}...")
+    new_rows = ingest_league(ROOT_DIR, LEAGUE)
+    print(f"Added {new_rows} new rows to the price store")
 
     print("Complete")
 
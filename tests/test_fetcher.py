@@ -0,0 +1,104 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetcher import BuildCodeFetcher
+
+CONCURRENT_FETCHES = 16
+
+
+class PasteServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.2):
+        super().__init__(('127.0.0.1', 0), PasteHandler)
+        self.delay = delay
+        self.hits = []
+        self.hits_lock = threading.Lock()
+
+
+class PasteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.hits_lock:
+            self.server.hits.append(self.path)
+        # Slow enough that every concurrent caller arrives while the first fetch is still in flight
+        time.sleep(self.server.delay)
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        body = f'code{self.path}'.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def paste_server():
+    server = PasteServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetcher(server, **kwargs) -> BuildCodeFetcher:
+    return BuildCodeFetcher(code_paths={'pobb.in': f'http://127.0.0.1:{server.server_port}/:id:'}, **kwargs)
+
+
+def fetch_concurrently(fetcher, url: str, count: int = CONCURRENT_FETCHES) -> list:
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def fetch(index):
+        barrier.wait()
+        results[index] = fetcher.fetch(url)
+
+    threads = [threading.Thread(target=fetch, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_fetches_hit_upstream_once(paste_server):
+    fetcher = make_fetcher(paste_server)
+    results = fetch_concurrently(fetcher, 'https://pobb.in/abc123')
+    assert results == ['code/abc123'] * CONCURRENT_FETCHES
+    assert paste_server.hits == ['/abc123']
+    fetcher.close()
+
+
+def test_cached_fetch_skips_upstream_until_expiry(paste_server):
+    fetcher = make_fetcher(paste_server, cache_ttl=0.5)
+    assert fetcher.fetch('pobb.in/abc123') == 'code/abc123'
+    assert fetcher.fetch('https://pobb.in/abc123') == 'code/abc123'
+    assert len(paste_server.hits) == 1
+    time.sleep(0.6)
+    assert fetcher.fetch('pobb.in/abc123') == 'code/abc123'
+    assert len(paste_server.hits) == 2
+    fetcher.close()
+
+
+def test_failed_fetch_is_shared_but_not_cached(paste_server):
+    fetcher = make_fetcher(paste_server)
+    assert fetch_concurrently(fetcher, 'pobb.in/missing') == [None] * CONCURRENT_FETCHES
+    assert len(paste_server.hits) == 1
+    assert fetcher.fetch('pobb.in/missing') is None
+    assert len(paste_server.hits) == 2
+    fetcher.close()
+
+
+def test_unknown_hosts_are_not_fetched(paste_server):
+    fetcher = make_fetcher(paste_server)
+    assert fetcher.fetch('https://example.com/abc123') is None
+    assert fetcher.fetch('') is None
+    assert paste_server.hits == []
+    fetcher.close()
@@ -0,0 +1,107 @@
+import os
+import json
+from datetime import date, timedelta
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+from clusterids import write_cluster_levels
+from ingest import ingest_dump
+from pricestore import PriceStore
+
+LEAGUE = 'Test'
+LEAGUE_START = date(2024, 1, 1)
+HEADER = 'League;Date;Id;Type;Name;BaseType;Variant;Links;Value;Confidence'
+# (id, type, name, base type, variant, links), the last one is first listed in the second part
+ITEMS = [
+    (1, 'UniqueArmour', 'Tabula Rasa', 'Simple Robe', '', '6L'),
+    (2, 'UniqueArmour', 'Tabula Rasa', 'Simple Robe', '', ''),
+    (3, 'UniqueWeapon', 'Voltaxic Rift', 'Spine Bow', '', '5L'),
+    (4, 'UniqueJewel', 'Watcher\'s Eye', 'Prismatic Jewel', '2 Jewels', ''),
+    (5, 'ClusterJewel', 'Cold Conduction', 'Small Cluster Jewel', '2 passives', ''),
+    (6, 'ClusterJewel', 'Cold Conduction', 'Small Cluster Jewel', '2 passives', ''),
+    (7, 'UniqueAccessory', 'Headhunter', 'Leather Belt', '', '')
+]
+NEW_ITEMS = 1
+CLUSTER_LEVELS = {5: 68, 6: 84}
+CONFIDENCES = ('High', 'Medium', 'Low')
+FIRST_PART_DAYS = 3
+ALL_DAYS = 6
+
+
+def dump_rows(days: int) -> list:
+    rows = []
+    for day in range(days):
+        items = ITEMS if day >= FIRST_PART_DAYS else ITEMS[:-NEW_ITEMS]
+        for index, (item_id, item_type, name, base_type, variant, links) in enumerate(items):
+            value = round(10 * (index + 1) * (1 + 0.15 * day), 2)
+            confidence = CONFIDENCES[(day + index) % len(CONFIDENCES)]
+            rows.append(f'{LEAGUE};{LEAGUE_START + timedelta(days=day)};{item_id};{item_type};{name};{base_type};{variant};{links};{value};{confidence}')
+    return rows
+
+
+def write_dump(path: str, days: int) -> str:
+    # poe.ninja dumps are cumulative, each one repeats every day since the league started
+    with ZipFile(path, 'w') as dump:
+        dump.writestr(f'{LEAGUE}.{LEAGUE_START}.items.csv', '\n'.join([HEADER] + dump_rows(days)) + '\n')
+    return path
+
+
+@pytest.fixture
+def dumps(tmp_path):
+    cluster_ids_file = str(tmp_path / 'levels.npy')
+    write_cluster_levels(cluster_ids_file, list(CLUSTER_LEVELS), list(CLUSTER_LEVELS.values()))
+    return {
+        'first': write_dump(str(tmp_path / 'first.zip'), FIRST_PART_DAYS),
+        'all': write_dump(str(tmp_path / 'all.zip'), ALL_DAYS),
+        'cluster_ids': cluster_ids_file
+    }
+
+
+def read_generation(store_dir: str) -> tuple:
+    generation_dir = os.path.realpath(store_dir)
+    with open(os.path.join(generation_dir, 'meta.json'), 'r', encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    meta.pop('generation')
+    arrays = {entry: np.load(os.path.join(generation_dir, entry)) for entry in sorted(os.listdir(generation_dir)) if entry.endswith('.npy')}
+    return meta, arrays
+
+
+def test_incremental_ingest_matches_full_rebuild(tmp_path, dumps):
+    incremental_dir = str(tmp_path / 'incremental' / 'store')
+    full_dir = str(tmp_path / 'full' / 'store')
+    first_rows = FIRST_PART_DAYS * (len(ITEMS) - NEW_ITEMS)
+
+    # A small chunk size makes the day boundary fall inside a chunk
+    assert ingest_dump(dumps['first'], dumps['cluster_ids'], incremental_dir, chunksize=4) == first_rows
+    assert ingest_dump(dumps['all'], dumps['cluster_ids'], incremental_dir, chunksize=4) == len(dump_rows(ALL_DAYS)) - first_rows
+    assert ingest_dump(dumps['all'], dumps['cluster_ids'], full_dir, chunksize=4) == len(dump_rows(ALL_DAYS))
+
+    incremental_meta, incremental_arrays = read_generation(incremental_dir)
+    full_meta, full_arrays = read_generation(full_dir)
+    assert incremental_meta == full_meta
+    assert incremental_arrays.keys() == full_arrays.keys()
+    for entry, values in full_arrays.items():
+        np.testing.assert_array_equal(incremental_arrays[entry], values, err_msg=entry)
+
+    incremental, full = PriceStore(os.path.realpath(incremental_dir)), PriceStore(os.path.realpath(full_dir))
+    assert incremental.rows == full.rows == len(dump_rows(ALL_DAYS))
+    assert incremental.latest_date == full.latest_date == np.datetime64(LEAGUE_START + timedelta(days=ALL_DAYS - 1))
+    for _, _, name, _, variant, links in ITEMS:
+        assert incremental.frame(incremental.select(name=name, links=links)).equals(full.frame(full.select(name=name, links=links)))
+        # Blank variants are stored as missing, which criteria spell as None, and blank links are read as 'None'
+        summary = full.summarise(name, variant=variant or None, links=links or 'None')
+        assert summary is not None
+        assert incremental.summarise(name, variant=variant or None, links=links or 'None') == summary
+        assert incremental.price_quantiles(name) == full.price_quantiles(name)
+    # Both cluster levels came from the mapping, so a level 85 jewel resolves to the 84 listing
+    assert incremental.resolve_cluster_levels([('Small Cluster Jewel', '2 passives', 'Cold Conduction', 85)]) == [84]
+
+
+def test_reingesting_a_dump_adds_nothing(tmp_path, dumps):
+    store_dir = str(tmp_path / 'store')
+    assert ingest_dump(dumps['all'], dumps['cluster_ids'], store_dir) == len(dump_rows(ALL_DAYS))
+    generation = os.path.realpath(store_dir)
+    assert ingest_dump(dumps['all'], dumps['cluster_ids'], store_dir) == 0
+    assert os.path.realpath(store_dir) == generation
@@ -0,0 +1,7 @@
+# WSGI entry point, e.g. `gunicorn --preload wsgi:server`. The app is created here rather than when
+# main is imported, so `python main.py` can pick debug or serve mode first. The league loads before
+# this module returns: a background warm-up thread would not survive a preloading server's fork.
+from main import create_app
+
+app = create_app(warm_up='blocking')
+server = app.server